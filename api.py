@@ -1,11 +1,21 @@
+import json
+
 import hug
 
 from revisum.pull_request import PullRequest
 from revisum.trainer import SnippetTrainer
 from revisum.collector import SnippetCollector
+from revisum.graphql import GraphQLTransport
 from revisum.snippet import Snippet
 from revisum.review import Review
 from revisum.chunk import Chunk
+from revisum.utils import gh_access_token, gh_webhook_secret
+from revisum.webhook import WebhookException, ingester, pull_from_payload, verify_signature
+
+
+def raw_body(body, **kwargs):
+    # Webhook signatures are computed over the raw body
+    return body.read()
 
 
 @hug.get('/snippets/{snippet_id}')
@@ -17,9 +27,7 @@ def retrieve_snippet(snippet_id: hug.types.text):
 
 @hug.get('/snippets/{snippet_id}/reviews')
 def retrieve_reviews(snippet_id: hug.types.text):
-    snippet = Snippet.load(snippet_id)
-
-    return snippet.to_json()['reviews']
+    return Snippet.load_reviews(snippet_id)
 
 
 @hug.get('/chunks/{chunk_id}')
@@ -29,6 +37,20 @@ def retrieve_chunk(chunk_id: hug.types.text):
     return chunk.to_json()
 
 
+@hug.get('/chunks/{chunk_id}/metrics')
+def retrieve_chunk_metrics(chunk_id: hug.types.text):
+    metrics = Chunk.load_metrics(chunk_id)
+    if not metrics:
+        return
+
+    return metrics.to_json()
+
+
+@hug.get('/chunks/{chunk_id}/meta')
+def retrieve_chunk_meta(chunk_id: hug.types.text):
+    return Chunk.load_meta(chunk_id)
+
+
 @hug.get('/chunks/{chunk_id}/compare/{other_chunk_id}')
 def compare_chunk(chunk_id: hug.types.text, other_chunk_id: hug.types.text):
     chunk = Chunk.compare(chunk_id, other_chunk_id)
@@ -66,8 +88,10 @@ def evaluate_pull(repo_id: hug.types.number, pull_number: hug.types.number,
 
 
 @hug.put('/repos/{repo_id}/collect')
-def collect(repo_id: hug.types.number, limit: hug.types.number = 10, iterations: hug.types.number = 20):
-    SnippetCollector(repo_id).collect(limit=limit)
+def collect(repo_id: hug.types.number, limit: hug.types.number = 10, iterations: hug.types.number = 20,
+            workers: hug.types.number = 0, graphql: hug.types.smart_boolean = False):
+    transport = GraphQLTransport(gh_access_token) if graphql else None
+    SnippetCollector(repo_id, transport=transport).collect(limit=limit, workers=workers)
     SnippetTrainer(repo_id).train(iterations=iterations)
 
     return 'Finished collecting and training for repository: {0}'.format(repo_id)
@@ -78,3 +102,34 @@ def train(repo_id: hug.types.number, iterations: hug.types.number = 20):
     SnippetTrainer(repo_id).train(iterations=iterations)
 
     return 'Finished training for repository: {0}'.format(repo_id)
+
+
+@hug.post('/webhooks/github', inputs={'application/json': raw_body})
+def github_webhook(request, response, body=None):
+    event = request.get_header('X-GitHub-Event')
+    if event == 'ping':
+        return 'pong'
+
+    # Only JSON deliveries are read raw, form encoded ones are parsed by hug
+    if (request.content_type or '').split(';')[0].strip() != 'application/json':
+        response.status = hug.HTTP_415
+        return 'Webhooks must deliver application/json'
+
+    body = body or b''
+    if gh_webhook_secret and not verify_signature(gh_webhook_secret, body, request.get_header('X-Hub-Signature-256')):
+        response.status = hug.HTTP_401
+        return 'Invalid signature'
+
+    try:
+        repo_id, repo_name, pull = pull_from_payload(event, json.loads(body.decode('utf-8')))
+    except (WebhookException, ValueError) as e:
+        response.status = hug.HTTP_400
+        return str(e)
+
+    if pull.state != 'closed':
+        return 'Ignored open pull request: {0}'.format(pull.number)
+
+    ingester.put(repo_id, repo_name, pull)
+    response.status = hug.HTTP_202
+
+    return 'Queued pull request {0} of repository: {1}'.format(pull.number, repo_id)
@@ -0,0 +1,357 @@
+import argparse
+import glob
+import os
+import pickle
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from lz4.frame import compress
+from pygments import lex
+from pygments.lexers import PythonLexer
+from pygments.token import Token
+
+from revisum.database import SCHEMA_VERSION, chunk, review, snippet
+from revisum.database.registry import Registry
+from revisum.parsers.python_parser import AstFileIndex, PythonFileParser
+from revisum.snapshot import Snapshot
+from revisum.tokenizer import LineTokenizer
+
+
+def timed(func, repeat=1):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) / repeat
+
+
+def report(title, results):
+    print('\n{0}'.format(title))
+    for name, before, after in results:
+        speedup = before / after if after else float('inf')
+        print('{0:<32} {1:>12.6f}s {2:>12.6f}s {3:>10.1f}x'.format(name, before, after, speedup))
+
+
+# Schema of the stores before versioning was introduced (schema version 1)
+schema_v1 = {
+    'chunks.db': [
+        'CREATE TABLE "chunk" ("id" INTEGER NOT NULL PRIMARY KEY, "chunk_id" VARCHAR(255) NOT NULL, '
+        '"sha1_hash" VARCHAR(255) NOT NULL, "name" VARCHAR(255) NOT NULL, "no" INTEGER NOT NULL, '
+        '"file_path" VARCHAR(255) NOT NULL, "start" INTEGER NOT NULL, "end" INTEGER NOT NULL, '
+        '"body" BLOB NOT NULL, "last_mod" DATETIME NOT NULL, "sloc" INTEGER NOT NULL, '
+        '"complexity" INTEGER NOT NULL, "cognitive" INTEGER NOT NULL)',
+    ],
+    'snippets.db': [
+        'CREATE TABLE "snippet" ("id" INTEGER NOT NULL PRIMARY KEY, "snippet_id" VARCHAR(255) NOT NULL, '
+        '"merged" INTEGER NOT NULL, "last_mod" DATETIME NOT NULL, "start" INTEGER NOT NULL, '
+        '"length" INTEGER NOT NULL, "source" VARCHAR(255) NOT NULL, "target" VARCHAR(255) NOT NULL, '
+        '"chunk_ids" BLOB NOT NULL)',
+    ],
+    'reviews.db': [
+        'CREATE TABLE "review" ("id" INTEGER NOT NULL PRIMARY KEY, "comment_id" INTEGER NOT NULL, '
+        '"pr_number" INTEGER NOT NULL, "pr_merged" INTEGER NOT NULL, "repo_id" INTEGER NOT NULL, '
+        '"state" VARCHAR(255) NOT NULL, "rating" REAL NOT NULL, "user_id" INTEGER NOT NULL, '
+        '"user_login" VARCHAR(255) NOT NULL, "body" VARCHAR(255) NOT NULL)',
+    ],
+}
+
+
+def make_v1_database(db_dir, repo_id, pulls):
+    now = datetime.now()
+    rand = random.Random(repo_id)
+
+    connections = {}
+    for db_name, statements in schema_v1.items():
+        connections[db_name] = con = sqlite3.connect(os.path.join(db_dir, db_name))
+        for statement in statements:
+            con.execute(statement)
+
+    chunk_rows = []
+    snippet_rows = []
+    review_rows = []
+    for pr_number in range(1, pulls + 1):
+        merged = pr_number % 3 != 0
+        for hunk_no in range(1, 3):
+            snippet_id = '{0}-1-{1}-{2}'.format(hunk_no, pr_number, repo_id)
+            last_mod = now - timedelta(minutes=rand.randrange(10 ** 6))
+            snippet_rows.append((snippet_id, merged, last_mod, 1, 20, 'a.py', 'a.py', os.urandom(64)))
+
+            for no in range(1, 3):
+                chunk_id = '{0}-{1}'.format(no, snippet_id)
+                lines = ['def func_{0}():'.format(pr_number)] + ['    return {0}'.format(i) for i in range(20)]
+                body = compress(pickle.dumps(lines, pickle.HIGHEST_PROTOCOL))
+                chunk_rows.append((
+                    chunk_id, '0' * 40, 'func', no, 'a.py', 1, 20, body, last_mod,
+                    rand.randrange(200), rand.randrange(50), rand.randrange(50)
+                ))
+
+        review_rows.append((pr_number, pr_number, merged, repo_id, 'APPROVED', 5.0, 1, 'user', 'LGTM'))
+
+    connections['chunks.db'].executemany(
+        'INSERT INTO chunk (chunk_id, sha1_hash, name, no, file_path, start, "end", body, last_mod, sloc, '
+        'complexity, cognitive) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', chunk_rows)
+    connections['snippets.db'].executemany(
+        'INSERT INTO snippet (snippet_id, merged, last_mod, start, length, source, target, chunk_ids) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', snippet_rows)
+    connections['reviews.db'].executemany(
+        'INSERT INTO review (comment_id, pr_number, pr_merged, repo_id, state, rating, user_id, user_login, body) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', review_rows)
+
+    for con in connections.values():
+        con.commit()
+        con.close()
+
+    return [row[0] for row in chunk_rows], [row[0] for row in snippet_rows]
+
+
+def schema_queries(db_dir, repo_id, chunk_ids, snippet_ids):
+    chunks = sqlite3.connect(os.path.join(db_dir, 'chunks.db'))
+    snippets = sqlite3.connect(os.path.join(db_dir, 'snippets.db'))
+    reviews = sqlite3.connect(os.path.join(db_dir, 'reviews.db'))
+
+    sample_chunks = random.Random(1).sample(chunk_ids, 200)
+    sample_snippets = random.Random(2).sample(snippet_ids, 200)
+
+    queries = [
+        ('Chunk.load (x200)', lambda: [
+            chunks.execute('SELECT * FROM chunk WHERE chunk_id = ?', (chunk_id,)).fetchone()
+            for chunk_id in sample_chunks
+        ]),
+        ('Snippet.exists (x200)', lambda: [
+            snippets.execute('SELECT 1 FROM snippet WHERE snippet_id = ?', (snippet_id,)).fetchone()
+            for snippet_id in sample_snippets
+        ]),
+        ('Review.newest_merged', lambda: reviews.execute(
+            'SELECT pr_number FROM review WHERE repo_id = ? AND pr_merged = 1 '
+            'ORDER BY pr_number DESC LIMIT 1', (repo_id,)).fetchone()),
+        ('Snippet.load_all (first page)', lambda: snippets.execute(
+            'SELECT snippet_id, merged, chunk_ids, source, target FROM snippet WHERE merged = 1 '
+            'ORDER BY last_mod DESC LIMIT 500').fetchall()),
+        ('Metrics.from_chunks', lambda: chunks.execute(
+            'SELECT sloc, complexity, cognitive FROM chunk').fetchall()),
+    ]
+
+    results = [(name, timed(query, repeat=3)) for name, query in queries]
+
+    for con in (chunks, snippets, reviews):
+        con.close()
+
+    return results
+
+
+def bench_schema(args):
+    repo_id = 1
+    with tempfile.TemporaryDirectory() as db_dir:
+        print('Creating synthetic schema v1 databases with {0} pull requests...'.format(args.pulls))
+        chunk_ids, snippet_ids = make_v1_database(db_dir, repo_id, args.pulls)
+
+        before = schema_queries(db_dir, repo_id, chunk_ids, snippet_ids)
+
+        started = time.perf_counter()
+        repo = Registry().repo(repo_id, path=db_dir)
+        for store in (chunk.store, snippet.store, review.store):
+            repo.database(store)
+        repo.close()
+        print('Migration took {0:.2f}s'.format(time.perf_counter() - started))
+
+        after = schema_queries(db_dir, repo_id, chunk_ids, snippet_ids)
+
+    report('Schema v1 vs v{0}'.format(SCHEMA_VERSION), [(b[0], b[1], a[1]) for b, a in zip(before, after)])
+
+
+def bench_snapshot(args):
+    repo_id = 1
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_dir = os.path.join(tmp_dir, 'source')
+        os.makedirs(db_dir)
+        print('Creating synthetic databases with {0} pull requests...'.format(args.pulls))
+        make_v1_database(db_dir, repo_id, args.pulls)
+        repo = Registry().repo(repo_id, path=db_dir)
+        for store in (chunk.store, snippet.store, review.store):
+            repo.database(store)
+        repo.close()
+        with open(os.path.join(db_dir, 'd2v.model'), 'wb') as f:
+            f.write(os.urandom(args.model_size * 1024 * 1024))
+
+        copy_time = timed(lambda: shutil.copytree(db_dir, os.path.join(tmp_dir, 'copy')))
+        raw_size = sum(os.path.getsize(os.path.join(db_dir, name)) for name in os.listdir(db_dir))
+
+        snapshot_path = os.path.join(tmp_dir, 'snapshot.lz4')
+        export_time = timed(lambda: Snapshot(repo_id, path=db_dir).export(snapshot_path))
+        import_time = timed(lambda: Snapshot.load(snapshot_path, path=os.path.join(tmp_dir, 'imported')))
+        snapshot_size = os.path.getsize(snapshot_path)
+
+    print('\nSnapshot vs. copying the raw files')
+    print('{0:<32} {1:>12.3f}s'.format('Copy raw files', copy_time))
+    print('{0:<32} {1:>12.3f}s'.format('Export snapshot', export_time))
+    print('{0:<32} {1:>12.3f}s'.format('Import snapshot', import_time))
+    print('{0:<32} {1:>12.1f}MB'.format('Raw files size', raw_size / 1024 / 1024))
+    print('{0:<32} {1:>12.1f}MB'.format('Snapshot size', snapshot_size / 1024 / 1024))
+
+
+def corpus(path, files):
+    paths = sorted(glob.glob(os.path.join(path, '**', '*.py'), recursive=True))
+    sources = []
+    for file_path in random.Random(1).sample(paths, min(files, len(paths))):
+        try:
+            with open(file_path, encoding='utf-8') as f:
+                sources.append((file_path, f.read()))
+        except (OSError, UnicodeDecodeError):
+            continue
+
+    return sources
+
+
+def chunk_spans(chunks):
+    return [(chunk.name, chunk.start, chunk.end, [[token[1] for token in line] for line in chunk._body])
+            for chunk in chunks or []]
+
+
+class SpanParser(PythonFileParser):
+    # Only the spans, building the chunks computes their metrics which takes most of the time
+
+    def _make_chunk(self, span):
+        name, start, end, _ = span
+        if (start, end) not in self._taken:
+            self._taken.add((start, end))
+            return name, start, end
+
+
+def parse_all(parser_class, sources, hunks, engine):
+    files, pulls, fallbacks = [], [], 0
+    started = time.perf_counter()
+    for file_path, content in sources:
+        parser = parser_class(0, 1, file_path, content=content, engine=engine)
+        files.append(parser.parse(file_no=1))
+        fallbacks += engine == 'ast' and not isinstance(parser.index, AstFileIndex)
+    file_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for file_path, content in sources:
+        parser = parser_class(1, 1, file_path, content=content, engine=engine)
+        pulls.append([parser.parse_single(hunk_no, 1, start, stop)
+                      for hunk_no, (start, stop) in enumerate(hunks[file_path], 1)])
+    hunk_time = time.perf_counter() - started
+
+    return files, pulls, fallbacks, file_time, hunk_time
+
+
+def bench_parser(args):
+    sources = corpus(args.path, args.files)
+    rand = random.Random(2)
+    hunks = {}
+    for file_path, content in sources:
+        length = content.count('\n') + 1
+        starts = sorted(rand.sample(range(1, length + 1), min(args.hunks, length)))
+        hunks[file_path] = [(start, start + rand.randint(0, 30)) for start in starts]
+
+    # Timed by the best of several interleaved runs
+    chunks = {}
+    times = {}
+    for _ in range(args.repeat):
+        for engine in ('lines', 'ast'):
+            files, pulls, fallbacks, file_time, hunk_time = parse_all(PythonFileParser, sources, hunks, engine)
+            if engine not in chunks:
+                files = [chunk_spans(file_chunks) for file_chunks in files]
+                pulls = [[chunk_spans(hunk_chunks) for hunk_chunks in file_pulls] for file_pulls in pulls]
+                chunks[engine] = (files, pulls, fallbacks)
+
+            _, _, _, span_file_time, span_hunk_time = parse_all(SpanParser, sources, hunks, engine)
+            run_times = (span_file_time, span_hunk_time, file_time, hunk_time)
+            times[engine] = [min(a, b) for a, b in zip(times.get(engine, run_times), run_times)]
+
+    lines, ast_engine = chunks['lines'], chunks['ast']
+    print('\n{0} files, {1} parsed by the line scanner after a syntax error'.format(len(sources), ast_engine[2]))
+    print('Equal chunks: {0}/{1} files, {2}/{3} hunks'.format(
+        sum(a == b for a, b in zip(lines[0], ast_engine[0])), len(sources),
+        sum(a == b for x, y in zip(lines[1], ast_engine[1]) for a, b in zip(x, y)),
+        sum(len(x) for x in lines[1])))
+    for (file_path, _), a, b in zip(sources, lines[0], ast_engine[0]):
+        if a != b:
+            print('Differs: {0}'.format(file_path))
+
+    report('Line scanner vs. syntax tree', [
+        ('Spans of whole files', times['lines'][0], times['ast'][0]),
+        ('Spans of hunks ({0} per file)'.format(args.hunks), times['lines'][1], times['ast'][1]),
+        ('Chunks of whole files', times['lines'][2], times['ast'][2]),
+        ('Chunks of hunks', times['lines'][3], times['ast'][3]),
+    ])
+
+
+def per_line_tokens(lines):
+    # The tokenizer before the single pass, tokens and elements were lexed separately
+    exclusions = [Token.Text, Token.Punctuation, Token.Comment, Token.Comment.Single]
+    char_exclusions = ['.', '=', '"', "'"]
+
+    def kept(attr):
+        result = []
+        for line in lines:
+            tokens = [token[attr] for token in lex(line, PythonLexer())
+                      if token[0] not in exclusions and token[1] not in char_exclusions]
+            if tokens:
+                result.append(tokens)
+        return result
+
+    return kept(1), kept(0)
+
+
+def bench_tokenizer(args):
+    blocks = []
+    for _, content in corpus(args.path, args.files):
+        lines = content.splitlines()
+        blocks.extend(lines[i:i + args.block] for i in range(0, len(lines), args.block))
+    line_count = sum(len(block) for block in blocks)
+
+    engines = [
+        ('Per line, lexed twice', per_line_tokens),
+        ('Single pass', lambda block: LineTokenizer(block).tokens_and_elements()),
+        ('Single pass, whole block', lambda block: LineTokenizer(block, whole=True).tokens_and_elements()),
+    ]
+    results = []
+    for name, tokenize in engines:
+        started = time.perf_counter()
+        results.append((name, [tokenize(block) for block in blocks], time.perf_counter() - started))
+
+    print('\n{0} blocks, {1} lines'.format(len(blocks), line_count))
+    print('{0:<32} {1:>12} {2:>12}'.format('', 'lines/s', 'equal'))
+    for name, tokenized, elapsed in results:
+        equal = sum(a == b for a, b in zip(results[0][1], tokenized))
+        print('{0:<32} {1:>12.0f} {2:>12}'.format(name, line_count / elapsed, '{0}/{1}'.format(equal, len(blocks))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for revisum.')
+    benchmarks = parser.add_subparsers(dest='benchmark')
+    benchmarks.required = True
+
+    schema_parser = benchmarks.add_parser('schema', help='Queries on schema v1 vs. current databases.')
+    schema_parser.add_argument('--pulls', type=int, default=50000)
+    schema_parser.set_defaults(func=bench_schema)
+
+    snapshot_parser = benchmarks.add_parser('snapshot', help='Snapshot export/import vs. copying raw files.')
+    snapshot_parser.add_argument('--pulls', type=int, default=20000)
+    snapshot_parser.add_argument('--model-size', type=int, default=20, help='Size of the fake model in MB.')
+    snapshot_parser.set_defaults(func=bench_snapshot)
+
+    parser_parser = benchmarks.add_parser('parser', help='Chunks found by the line scanner vs. the syntax tree.')
+    parser_parser.add_argument('--path', default=os.path.dirname(os.__file__), help='Corpus of Python files.')
+    parser_parser.add_argument('--files', type=int, default=300)
+    parser_parser.add_argument('--hunks', type=int, default=5, help='Random hunks per file.')
+    parser_parser.add_argument('--repeat', type=int, default=3, help='Runs to take the best time of.')
+    parser_parser.set_defaults(func=bench_parser)
+
+    tokenizer_parser = benchmarks.add_parser('tokenizer', help='Lines per second of the tokenizer engines.')
+    tokenizer_parser.add_argument('--path', default=os.path.dirname(os.__file__), help='Corpus of Python files.')
+    tokenizer_parser.add_argument('--files', type=int, default=100)
+    tokenizer_parser.add_argument('--block', type=int, default=30, help='Lines per tokenized block.')
+    tokenizer_parser.set_defaults(func=bench_tokenizer)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -44,10 +44,8 @@ def evaluate(repo_id):
         """
     ]
 
-    tokens = Snippet.as_tokens(code)
+    tokens, elements = Snippet.as_tokens_and_elements(code)
     print(tokens)
-
-    elements = Snippet.as_elements(code)
     print(elements)
 
     new_vector = model.infer_vector(tokens)
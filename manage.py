@@ -0,0 +1,132 @@
+import argparse
+import json
+import os
+from datetime import datetime
+
+from revisum.cache import file_cache
+from revisum.compaction import Compactor
+from revisum.database import schema_version
+from revisum.database.registry import consolidate as consolidate_repo, registered_stores, registry
+from revisum.snapshot import Snapshot
+from revisum.utils import get_project_root
+from revisum.webhook import ingester, pull_from_payload
+
+
+def stored_repo_ids():
+    data_dir = os.path.join(get_project_root(), 'data')
+    if not os.path.isdir(data_dir):
+        return []
+
+    return sorted(name for name in os.listdir(data_dir) if name.isdigit())
+
+
+def migrate(args):
+    for repo_id in args.repo_ids or stored_repo_ids():
+        repo = registry.repo(repo_id)
+
+        migrated = set()
+        for store in registered_stores():
+            db_name = repo.db_name(store)
+            if db_name in migrated or not os.path.isfile(os.path.join(repo.db_dir, db_name)):
+                continue
+
+            migrated.add(db_name)
+
+            db = repo.database(store)
+            print('{0}/{1}: schema version {2}'.format(repo_id, db_name, schema_version(db)))
+
+        registry.close(repo_id)
+
+
+def consolidate(args):
+    for repo_id in args.repo_ids or stored_repo_ids():
+        consolidate_repo(repo_id)
+
+
+def compact(args):
+    for repo_id in args.repo_ids or stored_repo_ids():
+        Compactor(repo_id).run(keep_versions=args.keep_versions, older_than=args.older_than,
+                               drop_closed=args.drop_closed, retrain=args.retrain,
+                               full_vacuum=args.full_vacuum)
+
+
+def export(args):
+    Snapshot(args.repo_id).export(args.file)
+
+
+def load(args):
+    Snapshot.load(args.file, force=args.force)
+
+
+def cache(args):
+    if args.clear:
+        file_cache.clear()
+
+    stats = file_cache.stats()
+    print('{0} entries, {1:.1f}MB of {2:.1f}MB'.format(
+        stats['entries'], stats['size'] / 1024 / 1024, file_cache.max_size / 1024 / 1024))
+
+
+def webhook(args):
+    with open(args.payload, encoding='utf-8') as f:
+        repo_id, repo_name, pull = pull_from_payload(args.event, json.load(f))
+
+    ingester.put(repo_id, repo_name, pull, background=False)
+    print('Collected {0} pull requests for: {1}'.format(ingester.drain(repo_id), repo_id))
+
+
+def date(value):
+    return datetime.strptime(value, '%Y-%m-%d')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the revisum repository databases.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    migrate_parser = commands.add_parser('migrate', help='Migrate databases in place to the current schema.')
+    migrate_parser.add_argument('repo_ids', nargs='*', help='Repository IDs to migrate (default: all).')
+    migrate_parser.set_defaults(func=migrate)
+
+    consolidate_parser = commands.add_parser('consolidate', help='Merge the databases of a repository into one file.')
+    consolidate_parser.add_argument('repo_ids', nargs='*', help='Repository IDs to consolidate (default: all).')
+    consolidate_parser.set_defaults(func=consolidate)
+
+    compact_parser = commands.add_parser('compact', help='Apply retention policies and reclaim disk space.')
+    compact_parser.add_argument('repo_ids', nargs='*', help='Repository IDs to compact (default: all).')
+    compact_parser.add_argument('--keep-versions', type=int, help='Keep the latest N versions of every function.')
+    compact_parser.add_argument('--older-than', type=date, help='Drop pull request data older than YYYY-MM-DD.')
+    compact_parser.add_argument('--drop-closed', action='store_true',
+                                help='Drop snippets of pull requests closed without merge.')
+    compact_parser.add_argument('--retrain', action='store_true', help='Retrain the model if chunks were removed.')
+    compact_parser.add_argument('--full-vacuum', action='store_true',
+                                help='Rewrite databases created without incremental vacuum once.')
+    compact_parser.set_defaults(func=compact)
+
+    export_parser = commands.add_parser('export', help='Export a repository into a single snapshot file.')
+    export_parser.add_argument('repo_id', help='Repository ID to export.')
+    export_parser.add_argument('file', help='Snapshot file to write.')
+    export_parser.set_defaults(func=export)
+
+    import_parser = commands.add_parser('import', help='Import a repository from a snapshot file.')
+    import_parser.add_argument('file', help='Snapshot file to read.')
+    import_parser.add_argument('--force', action='store_true', help='Replace existing repository data.')
+    import_parser.set_defaults(func=load)
+
+    cache_parser = commands.add_parser('cache', help='Show the size of the download cache.')
+    cache_parser.add_argument('--clear', action='store_true', help='Remove all cached downloads.')
+    cache_parser.set_defaults(func=cache)
+
+    webhook_parser = commands.add_parser('webhook', help='Replay a stored webhook delivery.')
+    webhook_parser.add_argument('payload', help='JSON payload of the delivery, '
+                                'e.g. fixtures/webhooks/pull_request_closed.json.')
+    webhook_parser.add_argument('--event', default='pull_request',
+                                help='Event of the delivery (default: pull_request).')
+    webhook_parser.set_defaults(func=webhook)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
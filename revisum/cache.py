@@ -0,0 +1,172 @@
+import os
+import re
+import tempfile
+import threading
+from contextlib import contextmanager
+from hashlib import sha1
+
+import lz4.frame
+from lz4.frame import decompress
+
+from .utils import get_project_root
+
+# Raw files pinned to a commit never change
+_raw_url = re.compile(r'^https://raw\.githubusercontent\.com/([^/]+/[^/]+)/([0-9a-f]{40})/(.+)$')
+
+
+def raw_file_key(repo_name, sha, path):
+    return ('raw', repo_name, sha, path)
+
+
+def diff_key(repo_id, pr_number, head_sha):
+    return ('diff', str(repo_id), str(pr_number), head_sha)
+
+
+def raw_url_key(url):
+    """Get the cache key of a raw file url, or None if the url is not pinned to a commit."""
+    match = _raw_url.match(url)
+    if match:
+        return raw_file_key(*match.groups())
+
+
+class FileCache(object):
+    """
+    Content-addressed on-disk cache for downloads that never change.
+
+    Entries are lz4 compressed files named by the hash of their key. Reading an
+    entry marks it as recently used, the least recently used entries are evicted
+    once the cache grows beyond `max_size` bytes.
+    """
+
+    def __init__(self, cache_dir, max_size=1024 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        digest = sha1('\0'.join(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest)
+
+    def get(self, key):
+        """
+        Get the cached text of a key.
+
+        :param key: The parts identifying the entry.
+        :type: tuple
+        :return: The cached text, or None on a miss.
+        :type: str
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return
+
+        with self._lock:
+            self.hits += 1
+
+        return decompress(data).decode('utf-8')
+
+    def open(self, key):
+        """
+        Open the cached text of a key for reading line by line, without loading it at once.
+
+        :return: The text stream, or None on a miss.
+        :type: file object
+        """
+        path = self._path(key)
+        try:
+            stream = lz4.frame.open(path, 'rt', encoding='utf-8', newline='')
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return
+
+        with self._lock:
+            self.hits += 1
+
+        return stream
+
+    def put(self, key, text):
+        with self.writer(key) as f:
+            f.write(text)
+
+    @contextmanager
+    def writer(self, key):
+        """Write the text of a key piece by piece, the entry only appears once it is complete."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first, so readers never see partial entries
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f, lz4.frame.open(f, 'wt', encoding='utf-8', newline='') as stream:
+                yield stream
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._entries())
+            else:
+                self._size += os.path.getsize(path)
+
+            if self._size > self.max_size:
+                self._evict()
+
+    def _entries(self):
+        if not os.path.isdir(self.cache_dir):
+            return
+
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            for name in os.listdir(prefix_dir):
+                path = os.path.join(prefix_dir, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def _evict(self):
+        # Make some room at once, instead of evicting on every write
+        target = self.max_size * 0.9
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        self._size = sum(size for _, size, _ in entries)
+
+        for path, size, _ in entries:
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
+
+    def stats(self):
+        entries = list(self._entries())
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(entries),
+            'size': sum(size for _, size, _ in entries),
+        }
+
+    def clear(self):
+        with self._lock:
+            for path, _, _ in list(self._entries()):
+                os.remove(path)
+            self._size = 0
+
+
+file_cache = FileCache(os.path.join(get_project_root(), 'data', 'cache'))
@@ -1,5 +1,6 @@
 import functools
 import pickle
+import time
 from collections import OrderedDict
 from datetime import datetime
 from hashlib import sha1
@@ -7,13 +8,15 @@ from itertools import chain
 from textwrap import dedent
 from lz4.frame import compress, decompress
 
+from peewee import JOIN, chunked
 from pygments import lex
 from pygments.lexers import PythonLexer
 
 from .metrics import Metrics, MetricsException
-from .tokenizer import LineTokenizer
+from .tokenizer import LineTokenizer, TokenizerException, decode_lexed, encode_lexed
 from .utils import b64_decode, b64_encode
-from .database.chunk import maybe_init, Chunk as DataChunk
+from .database import SQLITE_MAX_VARIABLES, upsert_many
+from .database.chunk import hash_body, maybe_init, maybe_init_bodies
 
 
 class ChunkException(Exception):
@@ -21,6 +24,8 @@ class ChunkException(Exception):
 
 
 class Chunk(object):
+    # Stay below the SQLite limit of bound variables per query
+    load_batch_size = 500
 
     def __init__(self, chunk_id, name, no, file_path, body, start, end):
         self.chunk_id = chunk_id
@@ -36,6 +41,7 @@ class Chunk(object):
         self._tokens = []
         self._metrics = None
         self._sha1_hash = None
+        self._body_hash = None
         self._encoded_b64_hash = None
 
         # Compute metrics
@@ -44,6 +50,16 @@ class Chunk(object):
     def __str__(self):
         return dedent('\n'.join(self.lines))
 
+    def __getstate__(self):
+        # Pygments token types are singletons, pickle them by name
+        state = self.__dict__.copy()
+        state['_body'] = encode_lexed(self._body)
+        return state
+
+    def __setstate__(self, state):
+        state['_body'] = decode_lexed(state['_body'])
+        self.__dict__.update(state)
+
     @classmethod
     def make_id(cls, no, snippet_id):
         return '{0}-{1}'.format(no, snippet_id)
@@ -81,6 +97,13 @@ class Chunk(object):
 
         return self._encoded_b64_hash
 
+    @property
+    def body_hash(self):
+        if not self._body_hash:
+            self._body_hash = hash_body(self.lines)
+
+        return self._body_hash
+
     @property
     def metrics(self):
         if not self._metrics:
@@ -119,67 +142,141 @@ class Chunk(object):
         return self._lines
 
     def _to_tokens(self):
-        self._tokens = LineTokenizer(self.lines).tokens
+        self._tokens = LineTokenizer(self.lines, lexed=self._body).tokens
         return self._tokens
 
     @classmethod
     def compare(cls, chunk_id, other_chunk_id):
-        chunk = cls.load(chunk_id)
-        other_chunk = cls.load(other_chunk_id)
+        chunk_metrics = cls.load_metrics(chunk_id)
+        other_metrics = cls.load_metrics(other_chunk_id)
+        if not chunk_metrics or not other_metrics:
+            return
 
         result = {}
-        rating = round(other_chunk.metrics.rating - chunk.metrics.rating, 2)
+        rating = round(other_metrics.rating - chunk_metrics.rating, 2)
         result['rating'] = rating
 
         metrics = {}
-        metrics['sloc'] = round(other_chunk.metrics.sloc - chunk.metrics.sloc, 2)
-        metrics['complexity'] = round(other_chunk.metrics.complexity - chunk.metrics.complexity, 2)
-        metrics['cognitive'] = round(other_chunk.metrics.cognitive - chunk.metrics.cognitive, 2)
+        metrics['sloc'] = round(other_metrics.sloc - chunk_metrics.sloc, 2)
+        metrics['complexity'] = round(other_metrics.complexity - chunk_metrics.complexity, 2)
+        metrics['cognitive'] = round(other_metrics.cognitive - chunk_metrics.cognitive, 2)
         result['metrics'] = metrics
 
         return result
 
+    @classmethod
+    def load_metrics(cls, chunk_id):
+        """
+        Load only the stored metrics of a chunk, without its body.
+
+        :return: The metrics of the chunk.
+        :type: Metrics object
+        """
+        repo_id = cls.repo_id(chunk_id)
+        DataChunk = maybe_init(repo_id)
+
+        row = (DataChunk
+               .select(DataChunk.sloc, DataChunk.complexity, DataChunk.cognitive)
+               .where(DataChunk.chunk_id == chunk_id)
+               .tuples()
+               .first())
+        if row:
+            metrics = Metrics(repo_id)
+            metrics.sloc, metrics.complexity, metrics.cognitive = row
+            return metrics
+
+    @classmethod
+    def load_meta(cls, chunk_id):
+        """
+        Load only the metadata of a chunk, without its body.
+
+        :return: The stored metadata of the chunk.
+        :type: dict
+        """
+        repo_id = cls.repo_id(chunk_id)
+        DataChunk = maybe_init(repo_id)
+
+        return (DataChunk
+                .select(DataChunk.chunk_id, DataChunk.sha1_hash, DataChunk.name, DataChunk.no,
+                        DataChunk.file_path, DataChunk.start, DataChunk.end, DataChunk.last_mod)
+                .where(DataChunk.chunk_id == chunk_id)
+                .dicts()
+                .first())
+
+    @classmethod
+    def exists(cls, chunk_id, path=None):
+        repo_id = cls.repo_id(chunk_id)
+        DataChunk = maybe_init(repo_id, path=path)
+
+        return DataChunk.select(DataChunk.id).where(DataChunk.chunk_id == chunk_id).exists()
+
     @classmethod
     def load(cls, chunk_id):
         repo_id = cls.repo_id(chunk_id)
-        maybe_init(repo_id)
+        DataChunk = maybe_init(repo_id)
+        DataBody = maybe_init_bodies(repo_id)
 
-        chunk_data = DataChunk.get_or_none(chunk_id=chunk_id)
+        chunk_data = cls._select(DataChunk, DataBody).where(DataChunk.chunk_id == chunk_id).first()
         if chunk_data:
+            return cls._from_data(repo_id, chunk_data)
 
-            chunk_lines = pickle.loads(decompress(chunk_data.body))
-            chunk_body = []
-            for line in chunk_lines:
-                chunk_body.append(list(lex(line, PythonLexer())))
+    @classmethod
+    def load_many(cls, repo_id, chunk_ids):
+        """
+        Load several chunks of a repository at once.
+
+        :param repo_id: The repository ID.
+        :param chunk_ids: The IDs of the chunks to load.
+        :type: iterable
+        :return: The loaded chunks by their ID, missing chunks are left out.
+        :type: dict
+        """
+        DataChunk = maybe_init(repo_id)
+        DataBody = maybe_init_bodies(repo_id)
+
+        chunks = {}
+        for batch in chunked(list(dict.fromkeys(chunk_ids)), cls.load_batch_size):
+            query = cls._select(DataChunk, DataBody).where(DataChunk.chunk_id.in_(batch))
+            for chunk_data in query:
+                chunks[chunk_data.chunk_id] = cls._from_data(repo_id, chunk_data)
+
+        return chunks
+
+    @staticmethod
+    def _select(DataChunk, DataBody):
+        return (DataChunk
+                .select(DataChunk, DataBody.body.alias('stored_body'), DataBody.tokens.alias('stored_tokens'))
+                .join(DataBody, JOIN.LEFT_OUTER, on=(DataChunk.body_hash == DataBody.body_hash))
+                .objects())
 
-            chunk = Chunk(
-                chunk_id, chunk_data.name, chunk_data.no, chunk_data.file_path,
-                chunk_body, chunk_data.start, chunk_data.end
-            )
-            chunk.sha1_hash = chunk_data.sha1_hash
+    @classmethod
+    def _from_data(cls, repo_id, chunk_data):
+        chunk_body = cls._deserialize(chunk_data)
 
-            metrics = Metrics(repo_id)
-            metrics.sloc = chunk_data.sloc
-            metrics.complexity = chunk_data.complexity
-            metrics.cognitive = chunk_data.cognitive
-            chunk.metrics = metrics
+        chunk = Chunk(
+            chunk_data.chunk_id, chunk_data.name, chunk_data.no, chunk_data.file_path,
+            chunk_body, chunk_data.start, chunk_data.end
+        )
+        chunk.sha1_hash = chunk_data.sha1_hash
+
+        metrics = Metrics(repo_id)
+        metrics.sloc = chunk_data.sloc
+        metrics.complexity = chunk_data.complexity
+        metrics.cognitive = chunk_data.cognitive
+        chunk.metrics = metrics
 
-            return chunk
+        return chunk
 
     @classmethod
     def load_snippet_id(cls, chunk_id, path=None):
-        repo_id = cls.repo_id(chunk_id)
-        maybe_init(repo_id, path=path)
-
-        chunk = DataChunk.get_or_none(chunk_id=chunk_id)
-        if chunk:
-            return chunk.chunk_id.split('-', 1)[1]
+        if cls.exists(chunk_id, path=path):
+            return chunk_id.split('-', 1)[1]
 
     def as_text(self, pretty=False):
         return '\n'.join(self.lines) if pretty else self.lines
 
     def as_tokens(self, pretty=False):
-        return self.merged_tokens if pretty else LineTokenizer(self.lines).tokens
+        return self.merged_tokens if pretty else self.tokens
 
     @classmethod
     def repo_id(cls, chunk_id):
@@ -198,37 +295,92 @@ class Chunk(object):
     def _serialize(self):
         return compress(pickle.dumps(self.lines, pickle.HIGHEST_PROTOCOL), compression_level=7)
 
-    def save(self, repo_id):
-        maybe_init(repo_id)
-
-        chunk = DataChunk.get_or_none(chunk_id=self.chunk_id)
-        if chunk:
-            (DataChunk
-             .update(chunk_id=self.chunk_id,
-                     sha1_hash=self.sha1_hash,
-                     name=self.name,
-                     no=self.no,
-                     file_path=self.file_path,
-                     start=self.start,
-                     end=self.end,
-                     body=self._serialize(),
-                     last_mod=datetime.now(),
-                     sloc=self.metrics.sloc,
-                     complexity=self.metrics.complexity,
-                     cognitive=self.metrics.cognitive)
-             .where(DataChunk.chunk_id == chunk.chunk_id)
-             .execute())
+    def _serialize_tokens(self):
+        return compress(pickle.dumps(encode_lexed(self._body), pickle.HIGHEST_PROTOCOL), compression_level=7)
+
+    @staticmethod
+    def _deserialize(chunk_data):
+        if chunk_data.stored_body:
+            body, tokens = chunk_data.stored_body, chunk_data.stored_tokens
         else:
-            (DataChunk
-             .create(chunk_id=self.chunk_id,
-                     sha1_hash=self.sha1_hash,
-                     name=self.name,
-                     no=self.no,
-                     file_path=self.file_path,
-                     start=self.start,
-                     end=self.end,
-                     body=self._serialize(),
-                     last_mod=datetime.now(),
-                     sloc=self.metrics.sloc,
-                     complexity=self.metrics.complexity,
-                     cognitive=self.metrics.cognitive))
+            # Chunks saved before bodies were stored by their content hash
+            body, tokens = chunk_data.body, chunk_data.tokens
+
+        if tokens:
+            try:
+                return decode_lexed(pickle.loads(decompress(tokens)))
+            except TokenizerException as e:
+                print('Re-lexing chunk {0}: {1}'.format(chunk_data.chunk_id, e))
+
+        # Chunks saved before the lexed tokens were stored
+        chunk_lines = pickle.loads(decompress(body))
+        return [list(lex(line, PythonLexer())) for line in chunk_lines]
+
+    def _to_row(self):
+        return {
+            'chunk_id': self.chunk_id,
+            'sha1_hash': self.sha1_hash,
+            'name': self.name,
+            'no': self.no,
+            'file_path': self.file_path,
+            'start': self.start,
+            'end': self.end,
+            'body': None,
+            'tokens': None,
+            'body_hash': self.body_hash,
+            'last_mod': datetime.now(),
+            'sloc': self.metrics.sloc,
+            'complexity': self.metrics.complexity,
+            'cognitive': self.metrics.cognitive,
+        }
+
+    def _to_body_row(self):
+        return {
+            'body_hash': self.body_hash,
+            'body': self._serialize(),
+            'tokens': self._serialize_tokens(),
+        }
+
+    def save(self, repo_id):
+        self.save_many(repo_id, [self], report=False)
+
+    @classmethod
+    def save_many(cls, repo_id, chunks, report=True):
+        DataChunk = maybe_init(repo_id)
+        DataBody = maybe_init_bodies(repo_id)
+
+        chunks = list(chunks)
+        started = time.perf_counter()
+        with DataChunk._meta.database.atomic():
+            cls._save_bodies(DataBody, chunks)
+            upsert_many(DataChunk, [chunk._to_row() for chunk in chunks], DataChunk.chunk_id)
+        elapsed = time.perf_counter() - started
+
+        if report:
+            rate = len(chunks) / elapsed if elapsed else float(len(chunks))
+            print('Saved {0} chunks for: {1} ({2:.0f} rows/s)'.format(len(chunks), repo_id, rate))
+
+    @staticmethod
+    def _save_bodies(DataBody, chunks):
+        """Store the bodies which are not known yet, each one only once."""
+        new_bodies = {}
+        for chunk in chunks:
+            new_bodies.setdefault(chunk.body_hash, chunk)
+
+        for batch in chunked(list(new_bodies), SQLITE_MAX_VARIABLES):
+            query = DataBody.select(DataBody.body_hash).where(DataBody.body_hash.in_(batch))
+            for stored in query:
+                del new_bodies[stored.body_hash]
+
+        rows = [chunk._to_body_row() for chunk in new_bodies.values()]
+        for batch in chunked(rows, SQLITE_MAX_VARIABLES // 3):
+            DataBody.insert_many(batch).on_conflict_ignore().execute()
+
+    @classmethod
+    def delete_many(cls, repo_id, chunk_ids):
+        """Delete chunks, their bodies are removed by compaction once unused."""
+        DataChunk = maybe_init(repo_id)
+
+        with DataChunk._meta.database.atomic():
+            for batch in chunked(list(chunk_ids), SQLITE_MAX_VARIABLES):
+                DataChunk.delete().where(DataChunk.chunk_id.in_(batch)).execute()
@@ -1,23 +1,47 @@
+import multiprocessing
 import os
 import shutil
 import zipfile
-from pathlib import Path
+from collections import deque
+from fnmatch import fnmatch
+from itertools import chain
 
-import requests
+from github import GithubException
 
+from .cache import file_cache, raw_url_key
+from .chunk import Chunk
+from .fetcher import fetcher
+from .graphql import graphql_pulls
+from .local_repo import LocalPullRequest, LocalRepository, LocalRepositoryException
 from .metrics import Metrics
 from .pull_request import PullRequest
+from .pull_queue import PullQueue, process_pull
 from .review import Review
 from .snippet import Snippet
-from .utils import get_project_root, gh_session
+from .state import PullCursor, RepoState
+from .utils import get_project_root, gh_repo
 from .parsers.python_parser import PythonFileParser
 
 
 class SnippetCollector(object):
-
-    def __init__(self, repo):
-        self._gh_session = gh_session()
-        self._repo = self._gh_session.get_repo(repo)
+    # Files of the default branch to parse, matched against their path in the repository
+    branch_include = ('*.py',)
+    branch_exclude = ()
+    # Larger files are most likely generated or data, skip them before parsing
+    branch_max_file_size = 1024 * 1024
+    pull_request_class = PullRequest
+    # The compare API lists at most this many files, larger changes re-sync the whole branch
+    compare_max_files = 300
+
+    def __init__(self, repo, transport=None):
+        """
+        :param repo: The repository ID or full name.
+        :param transport: Fetch pull requests with their reviews and comments by
+            GraphQL through this transport, instead of by the REST API.
+        :type: GraphQLTransport or RecordedTransport object
+        """
+        self._repo = gh_repo(repo)
+        self._transport = transport
         self._tmp_dir = os.path.join(get_project_root(), 'data', 'tmp')
 
         self.name = self._repo.raw_data['name']
@@ -25,19 +49,25 @@ class SnippetCollector(object):
         self.repo_id = self._repo.raw_data['id']
         self.branch = self._repo.default_branch
 
-    def collect(self, limit):
+    def collect(self, limit, workers=None):
         snippets = []
 
         if self._is_first_run():
-            self._download_branch()
-            self._unpack_branch()
+            branch_sha = self._branch_sha()
+            self._download_branch(branch_sha)
             snippets += self.from_branch()
+            RepoState(self.repo_id).set('branch_sha', branch_sha)
+        else:
+            snippets += self.sync_branch()
 
-        snippets += self.from_pulls(limit=limit)
+        snippets += self.from_pulls(limit=limit, workers=workers)
 
         if snippets:
             Metrics(self.repo_id).save()
 
+        stats = file_cache.stats()
+        print('File cache: {0} hits, {1} misses, {2} entries'.format(stats['hits'], stats['misses'], stats['entries']))
+
         return snippets
 
     def _is_first_run(self):
@@ -46,9 +76,9 @@ class SnippetCollector(object):
             return True
         return False
 
-    def _download_branch(self):
-        url = 'https://codeload.github.com/{0}/zip/{1}'.format(self.repo_name, self.branch)
-        response = requests.get(url, stream=True)
+    def _download_branch(self, sha=None):
+        url = 'https://codeload.github.com/{0}/zip/{1}'.format(self.repo_name, sha or self.branch)
+        response = fetcher.get(url, stream=True)
 
         file_name = '{0}.zip'.format(self.repo_id)
         file_path = os.path.join(self._tmp_dir, file_name)
@@ -60,52 +90,240 @@ class SnippetCollector(object):
         print('Download completed!')
         del response
 
-    def _unpack_branch(self):
-        file_name = '{0}.zip'.format(self.repo_id)
-        source = os.path.join(self._tmp_dir, file_name)
-        dest = os.path.join(self._tmp_dir, str(self.repo_id))
+    @staticmethod
+    def _is_wanted(file_name, size, include, exclude, max_file_size):
+        if not any(fnmatch(file_name, pattern) for pattern in include):
+            return False
+        if any(fnmatch(file_name, pattern) for pattern in exclude):
+            return False
 
-        print('Unpacking file {0} for {1}...'.format(file_name, self.repo_name))
-        with zipfile.ZipFile(source, 'r') as zip_ref:
-            zip_ref.extractall(dest)
+        if size > max_file_size:
+            print('Skipping {0}: {1} bytes exceed the file size budget'.format(file_name, size))
+            return False
 
-        print('Unpack completed!')
-        os.remove(source)
+        return True
 
-    def from_branch(self, delete=True):
-        dir_name = '{0}-{1}'.format(self.name, self.branch)
-        path = Path(os.path.join(self._tmp_dir, str(self.repo_id)))
+    def _branch_files(self, archive, include, exclude, max_file_size):
+        """Yield the name and content of the files to parse, read straight from the archive."""
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
 
-        snippets = []
+            # Strip the `<name>-<branch>/` folder every entry is stored in
+            file_name = info.filename.split('/', 1)[-1]
+            if not self._is_wanted(file_name, info.file_size, include, exclude, max_file_size):
+                continue
 
-        files = list(path.rglob('*.py'))
-        for file_no, file_path in enumerate(files, 1):
-            file_name = file_path.relative_to(os.path.join(path, dir_name))
-            parser = PythonFileParser(0, self.repo_id, file_path, file_name=file_name)
-            chunks = parser.parse(file_no=file_no)
-            if not chunks:
+            try:
+                content = archive.read(info).decode('utf-8')
+            except UnicodeDecodeError:
+                print('Skipping {0}: not UTF-8 encoded'.format(file_name))
                 continue
 
-            snippet_id = Snippet.make_id(0, file_no, 0, self.repo_id)
-            snippet = Snippet(snippet_id, True, chunks, file_name, file_name)
-            snippets.append(snippet)
+            yield file_name, content
+
+    def _parse_branch_file(self, file_no, file_name, content):
+        parser = PythonFileParser(0, self.repo_id, file_name, content=content)
+        chunks = parser.parse(file_no=file_no)
+        if not chunks:
+            return
+
+        snippet_id = Snippet.make_id(0, file_no, 0, self.repo_id)
+        return Snippet(snippet_id, True, chunks, file_name, file_name)
+
+    def _save_branch(self, files):
+        """Parse and save the files of the default branch, given as name and content."""
+        snippets = []
+
+        for file_no, (file_name, content) in enumerate(files, 1):
+            snippet = self._parse_branch_file(file_no, file_name, content)
+            if snippet:
+                snippets.append(snippet)
 
         print('Saving snippets for: {0}...'.format(self.repo_id))
-        for snippet in snippets:
-            snippet.save()
-            for chunk in snippet.chunks:
-                chunk.save(self.repo_id)
+        Snippet.save_many(self.repo_id, snippets)
+        Chunk.save_many(self.repo_id, chain.from_iterable(s.chunks for s in snippets))
+
+        return snippets
+
+    def from_branch(self, delete=True, include=None, exclude=None, max_file_size=None):
+        """
+        Collect the snippets of the default branch from its downloaded archive.
+
+        :param delete: Delete the archive afterwards.
+        :type: bool
+        :param include: Globs of the files to parse (default: `branch_include`).
+        :type: tuple
+        :param exclude: Globs of the files to skip (default: `branch_exclude`).
+        :type: tuple
+        :param max_file_size: Skip files larger than this many bytes (default: `branch_max_file_size`).
+        :type: int
+        :return: The collected snippets.
+        :type: list
+        """
+        include = include if include is not None else self.branch_include
+        exclude = exclude if exclude is not None else self.branch_exclude
+        max_file_size = max_file_size if max_file_size is not None else self.branch_max_file_size
+
+        source = os.path.join(self._tmp_dir, '{0}.zip'.format(self.repo_id))
+
+        print('Reading branch {0} for {1}...'.format(self.branch, self.repo_name))
+        with zipfile.ZipFile(source, 'r') as archive:
+            snippets = self._save_branch(self._branch_files(archive, include, exclude, max_file_size))
 
         if delete:
-            print('Deleting branch folder {0}...'.format(self.repo_id))
-            shutil.rmtree(path)
+            print('Deleting branch archive {0}...'.format(self.repo_id))
+            os.remove(source)
+
+        return snippets
+
+    def _branch_sha(self):
+        return self._repo.get_branch(self.branch).commit.sha
+
+    def _changed_files(self, base, head):
+        """
+        Get the files changed between two commits of the branch.
+
+        :return: The changed and the removed paths, or None if they are unknown.
+        :type: tuple
+        """
+        try:
+            comparison = self._repo.compare(base, head)
+        except GithubException as e:
+            # E.g. the base commit is gone after a force push
+            print('Comparing {0}...{1} failed: {2}'.format(base, head, e))
+            return
+
+        # After a force push the files are compared to the merge base, which misses
+        # those only changed by the dropped commits.
+        if comparison.status not in ('ahead', 'identical'):
+            print('Branch {0} was rewritten ({1}), re-syncing all files'.format(self.branch, comparison.status))
+            return
+
+        files = comparison.files
+        if len(files) >= self.compare_max_files:
+            return
+
+        changed, removed = set(), set()
+        for changed_file in files:
+            if changed_file.status == 'removed':
+                removed.add(changed_file.filename)
+                continue
+
+            changed.add(changed_file.filename)
+            if changed_file.status == 'renamed':
+                removed.add(changed_file.previous_filename)
+
+        return changed, removed
+
+    def _branch_file(self, sha, path):
+        url = 'https://raw.githubusercontent.com/{0}/{1}/{2}'.format(self.repo_name, sha, path)
+        return self._fetch_remote(url)
+
+    def _refresh_branch(self, head):
+        """Replace all stored snippets of the branch by the ones of its head."""
+        print('Re-syncing the whole branch {0} for {1}...'.format(self.branch, self.repo_name))
+
+        stored = Snippet.branch_files(self.repo_id)
+        Chunk.delete_many(self.repo_id, chain.from_iterable(chunk_ids for _, chunk_ids in stored.values()))
+        Snippet.delete_many(self.repo_id, [snippet_id for snippet_id, _ in stored.values()])
+
+        self._download_branch(head)
+        return self.from_branch()
+
+    def sync_branch(self):
+        """
+        Bring the stored snippets of the default branch up to date with its head.
+
+        Only the files changed since the last collected commit are fetched and parsed,
+        chunks of changed files are replaced and those of removed files are retired.
+
+        :return: The snippets of the changed files.
+        :type: list
+        """
+        state = RepoState(self.repo_id)
+        base = state.get('branch_sha')
+        head = self._branch_sha()
+        if base == head:
+            print('Branch {0} is up to date for: {1}'.format(self.branch, self.repo_name))
+            return []
+
+        changes = self._changed_files(base, head) if base else None
+        if changes is None:
+            snippets = self._refresh_branch(head)
+            state.set('branch_sha', head)
+            return snippets
+
+        changed, removed = changes
+        # The size budget is checked once the files are fetched
+        wanted = sorted(path for path in changed
+                        if self._is_wanted(path, 0, self.branch_include, self.branch_exclude, float('inf')))
+        contents = fetcher.executor.map(lambda path: self._branch_file(head, path), wanted)
+
+        stored = Snippet.branch_files(self.repo_id)
+        next_no = max((int(snippet_id.split('-')[1]) for snippet_id, _ in stored.values()), default=0) + 1
+
+        snippets = []
+        retired = set(changed | removed) - set(wanted)
+        retired_chunks = []
+
+        for file_name, content in zip(wanted, contents):
+            if content is not None and len(content.encode('utf-8')) > self.branch_max_file_size:
+                print('Skipping {0}: exceeds the file size budget'.format(file_name))
+                content = None
+
+            if content is None:
+                retired.add(file_name)
+                continue
+
+            if file_name in stored:
+                snippet_id, chunk_ids = stored[file_name]
+                file_no = int(snippet_id.split('-')[1])
+            else:
+                chunk_ids = []
+                file_no = next_no
+                next_no += 1
+
+            snippet = self._parse_branch_file(file_no, file_name, content)
+            if snippet:
+                snippets.append(snippet)
+                retired_chunks += [chunk_id for chunk_id in chunk_ids if chunk_id not in snippet.chunk_ids]
+            else:
+                retired.add(file_name)
+
+        retired = [stored[file_name] for file_name in retired if file_name in stored]
+        retired_chunks += chain.from_iterable(chunk_ids for _, chunk_ids in retired)
+
+        Snippet.save_many(self.repo_id, snippets)
+        Chunk.save_many(self.repo_id, chain.from_iterable(s.chunks for s in snippets))
+        Chunk.delete_many(self.repo_id, retired_chunks)
+        Snippet.delete_many(self.repo_id, [snippet_id for snippet_id, _ in retired])
+        state.set('branch_sha', head)
+
+        print('Synced {0} changed and {1} retired files of branch {2} for: {3}'.format(
+            len(snippets), len(retired), self.branch, self.repo_name))
 
         return snippets
 
+    def _fetch_remote(self, snippet_url):
+        # Only urls pinned to a commit can be cached
+        key = raw_url_key(snippet_url)
+        content = file_cache.get(key) if key else None
+        if content is None:
+            response = fetcher.get(snippet_url)
+            if not response:
+                return
+
+            content = response.text
+            if key:
+                file_cache.put(key, content)
+
+        return content
+
     def from_remote(self, snippet_url):
-        raw_snippet = requests.get(snippet_url)
-        if raw_snippet:
-            parser = PythonFileParser(0, self.repo_id, snippet_url, raw_file=raw_snippet)
+        content = self._fetch_remote(snippet_url)
+        if content is not None:
+            parser = PythonFileParser(0, self.repo_id, snippet_url, content=content)
             chunks = parser.parse()
             if not chunks:
                 return
@@ -114,35 +332,256 @@ class SnippetCollector(object):
             snippet = Snippet(snippet_id, False, chunks, snippet_url, snippet_url)
             return snippet
 
-    def from_pulls(self, update=True, limit=None):
-        pulls = self._repo.get_pulls(state='all', sort='updated', direction='desc')
-        newest_review = Review.newest_merged(self._repo.id) if update else None
-        limit = limit or 50
+    def _pulls(self):
+        if self._transport:
+            return graphql_pulls(self.repo_name, self._transport)
 
-        snippets_count = 0
-        snippets = []
+        return self._repo.get_pulls(state='all', sort='updated', direction='desc')
+
+    def _handed_pull(self, pull):
+        # Pull requests fetched by GraphQL are handed over, PyGithub ones are fetched again
+        return pull if self._transport else None
+
+    def _resumed_pull(self, pr_number):
+        # Unfinished jobs of the queue are fetched again by number
+        return None
+
+    def _listed_pulls(self, update, cursor=None):
+        """
+        Yield the pull requests to collect in listing order, until an early stop rule applies.
+
+        When resuming an interrupted collection, the pull requests it handled are skipped
+        and the early stop rules only apply once the listing is past where it stopped.
+        """
+        pulls = self._pulls()
+        newest_review = Review.newest_merged(self.repo_id) if update else None
+        known_pulls = Snippet.known_pulls(self.repo_id) if update else set()
+        resuming = cursor is not None and cursor.resuming
 
         for pull in pulls:
 
+            if resuming:
+                position = cursor.locate(pull.number, pull.updated_at)
+                if position == 'handled':
+                    continue
+                if position != 'ahead':
+                    yield pull
+                    continue
+
+                print('Resuming collection at pull request {0}'.format(pull.number))
+                resuming = False
+
             if update and newest_review and newest_review == pull.number:
                 print('Reached newest review ({0})!'.format(newest_review))
-                break
+                return
 
-            pull_request = PullRequest(self._repo.id, pull.number, self._repo.full_name, pull.head.sha)
-            if pull_request.supported_snippets:
+            # `merged_at` is part of the listing, `merged` would fetch every pull request
+            if update and pull.merged_at and pull.number in known_pulls:
+                print('Reached newest pull request ({0})!'.format(pull.number))
+                return
 
-                if update and pull_request.merged and pull_request.exists():
-                    print('Reached newest pull request ({0})!'.format(pull.number))
-                    break
+            yield pull
+
+    def from_pulls(self, update=True, limit=None, workers=None):
+        """
+        Collect the pull requests of the repository, most recently updated first.
+
+        The position of the collection is checkpointed after every pull request,
+        so an interrupted collection continues where it stopped on the next run.
+        """
+        limit = limit or 50
+        cursor = PullCursor(self.repo_id)
+        if cursor.resuming:
+            print('Resuming interrupted collection of pull requests for: {0}'.format(self.repo_id))
+        cursor.start()
+
+        if workers and workers > 1:
+            snippets = self._from_pulls_parallel(update, limit, workers, cursor)
+            cursor.finish()
+            return snippets
+
+        snippets_count = cursor.collected
+        snippets = []
 
+        for pull in self._listed_pulls(update, cursor):
+
+            cursor.begin(pull.number)
+            pull_request = self.pull_request_class(self.repo_id, pull.number, self.repo_name, pull.head.sha,
+                                                   pull=self._handed_pull(pull))
+            if pull_request.supported_snippets:
                 snippets += pull_request.snippets
                 pull_request.save()
                 snippets_count += 1
 
                 print('Total collected pull requests: [{count}/{limit}]'.format(count=snippets_count, limit=limit))
 
-            if snippets_count == limit:
+            cursor.advance(pull.number, pull.updated_at, snippets_count)
+
+            if snippets_count >= limit:
                 print('Reached pull requests limit ({0})!'.format(limit))
                 break
 
+        cursor.finish()
+
         return snippets
+
+    def _from_pulls_parallel(self, update, limit, workers, cursor):
+        """
+        Collect pull requests with several worker processes.
+
+        The pull requests are enqueued in listing order and fetched, parsed and
+        measured by the workers, while this process is the only writer. Results
+        are saved in listing order, so the limit applies as when collecting
+        sequentially, and at most two jobs per worker are processed in advance.
+        """
+        queue = PullQueue(self.repo_id)
+        resumed = queue.unfinished()
+        if resumed:
+            print('Resuming {0} unfinished pull requests for: {1}'.format(len(resumed), self.repo_id))
+
+        resumed_numbers = {pr_number for pr_number, _, _ in resumed}
+        # The listing position of resumed jobs is unknown
+        resumed = [(pr_number, merged, head_sha, None, self._resumed_pull(pr_number))
+                   for pr_number, merged, head_sha in resumed]
+        listed = ((pull.number, pull.merged_at is not None, pull.head.sha, pull.updated_at, self._handed_pull(pull))
+                  for pull in self._listed_pulls(update, cursor) if pull.number not in resumed_numbers)
+
+        window = workers * 2
+        in_flight = deque()
+        snippets_count = cursor.collected
+        snippets = []
+
+        with multiprocessing.Pool(workers) as pool:
+
+            def results():
+                for pr_number, merged, head_sha, updated_at, pull in chain(resumed, listed):
+                    queue.put(pr_number, merged, head_sha)
+                    cursor.begin(pr_number)
+                    job = pool.apply_async(process_pull, (self.repo_id, self.repo_name, pr_number, head_sha,
+                                                          pull, self.pull_request_class))
+                    in_flight.append((pr_number, updated_at, job))
+                    if len(in_flight) >= window:
+                        yield in_flight.popleft()
+
+                while in_flight:
+                    yield in_flight.popleft()
+
+            for pr_number, updated_at, job in results():
+                try:
+                    collected = job.get()
+                except Exception as e:
+                    print('Failed to collect pull request {0}: {1!r}'.format(pr_number, e))
+                    queue.finish(pr_number, 'failed')
+                    cursor.advance(pr_number, updated_at, snippets_count)
+                    continue
+
+                if not collected:
+                    queue.finish(pr_number, 'skipped')
+                    cursor.advance(pr_number, updated_at, snippets_count)
+                    continue
+
+                pull_snippets, reviews = collected
+                PullRequest.save_snippets(self.repo_id, pull_snippets, reviews)
+                queue.finish(pr_number, 'done')
+                snippets += pull_snippets
+                snippets_count += 1
+                cursor.advance(pr_number, updated_at, snippets_count)
+
+                print('Total collected pull requests: [{count}/{limit}]'.format(count=snippets_count, limit=limit))
+
+                if snippets_count >= limit:
+                    print('Reached pull requests limit ({0})!'.format(limit))
+                    break
+
+        # Jobs processed in advance beyond the limit are collected by a later run
+        queue.discard(pr_number for pr_number, _, _ in in_flight)
+
+        return snippets
+
+
+class LocalSnippetCollector(SnippetCollector):
+    """
+    Collects snippets from a local clone of a repository, without the GitHub API.
+
+    The default branch is read from the tree of the clone and pull requests from
+    its merge commits and `refs/pull/*/head`. No reviews are collected.
+    """
+    pull_request_class = LocalPullRequest
+
+    def __init__(self, repo_id, repo_name, path, branch=None):
+        """
+        :param repo_id: The GitHub ID of the repository, the collected data is stored by it.
+        :param repo_name: The full name of the repository.
+        :param path: The path of the local clone.
+        :param branch: The default branch (default: the checked out branch).
+        """
+        self._repo = None
+        self._transport = None
+        self._local = LocalRepository(path)
+        self._tmp_dir = os.path.join(get_project_root(), 'data', 'tmp')
+
+        self.name = repo_name.split('/')[-1]
+        self.repo_name = repo_name
+        self.repo_id = repo_id
+        self.branch = branch or self._local.default_branch()
+
+    def _download_branch(self, sha=None):
+        # The branch is read from the clone
+        pass
+
+    def _branch_sha(self):
+        return self._local.git('rev-parse', self.branch).decode('utf-8').strip()
+
+    def _changed_files(self, base, head):
+        try:
+            output = self._local.git('diff', '--name-status', '--no-renames', '-z', base, head)
+        except LocalRepositoryException as e:
+            print('Comparing {0}...{1} failed: {2}'.format(base, head, e))
+            return
+
+        fields = output.decode('utf-8').split('\0')
+        changed, removed = set(), set()
+        for status, path in zip(fields[0::2], fields[1::2]):
+            if status == 'D':
+                removed.add(path)
+            else:
+                changed.add(path)
+
+        return changed, removed
+
+    def _branch_file(self, sha, path):
+        content = self._local.file(sha, path)
+        if content is not None:
+            try:
+                return content.decode('utf-8')
+            except UnicodeDecodeError:
+                print('Skipping {0}: not UTF-8 encoded'.format(path))
+
+    def _local_files(self, include, exclude, max_file_size):
+        files = [(sha, path) for sha, size, path in self._local.tree(self.branch)
+                 if self._is_wanted(path, size, include, exclude, max_file_size)]
+
+        for (_, file_name), content in zip(files, self._local.blobs(sha for sha, _ in files)):
+            try:
+                yield file_name, content.decode('utf-8')
+            except UnicodeDecodeError:
+                print('Skipping {0}: not UTF-8 encoded'.format(file_name))
+
+    def from_branch(self, delete=True, include=None, exclude=None, max_file_size=None):
+        include = include if include is not None else self.branch_include
+        exclude = exclude if exclude is not None else self.branch_exclude
+        max_file_size = max_file_size if max_file_size is not None else self.branch_max_file_size
+
+        print('Reading branch {0} of the clone for {1}...'.format(self.branch, self.repo_name))
+        return self._save_branch(self._local_files(include, exclude, max_file_size))
+
+    def _pulls(self):
+        return self._local.pulls(self.branch)
+
+    def _handed_pull(self, pull):
+        return pull
+
+    def _resumed_pull(self, pr_number):
+        for pull in self._pulls():
+            if pull.number == pr_number:
+                return pull
@@ -0,0 +1,203 @@
+import os.path
+import pickle
+from itertools import groupby
+
+from peewee import JOIN, chunked
+
+from .chunk import Chunk
+from .snippet import Snippet
+from .database.chunk import maybe_init as maybe_init_chunks, maybe_init_bodies
+from .database.registry import registered_stores, registry
+from .database.review import maybe_init as maybe_init_reviews
+from .database.snippet import maybe_init as maybe_init_snippets
+
+
+class Compactor(object):
+    """
+    Remove superseded data of a repository and reclaim its disk space.
+
+    Chunks of the default branch are never removed by the retention policies,
+    they are kept up to date by re-syncing the branch instead.
+    """
+    # Rows deleted per transaction, keeps writes short for concurrent readers
+    batch_size = 500
+    # Pages freed per incremental vacuum step
+    vacuum_pages = 1000
+
+    def __init__(self, repo_id, path=None):
+        self.repo_id = repo_id
+        self.path = path
+        self._chunks = maybe_init_chunks(repo_id, path=path)
+        self._bodies = maybe_init_bodies(repo_id, path=path)
+        self._snippets = maybe_init_snippets(repo_id, path=path)
+        self._reviews = maybe_init_reviews(repo_id, path=path)
+
+    def run(self, keep_versions=None, older_than=None, drop_closed=False, retrain=False, full_vacuum=False):
+        """
+        Apply the retention policies, then vacuum and analyze the databases.
+
+        :param keep_versions: Keep only the versions of every function from the latest N pull requests.
+        :type: int
+        :param older_than: Drop pull request data last modified before this date.
+        :type: datetime
+        :param drop_closed: Drop snippets of pull requests closed without merge.
+        :type: bool
+        :param retrain: Rebuild the model so it no longer contains removed chunks.
+        :type: bool
+        :param full_vacuum: Enable incremental vacuuming for databases created without it.
+            This rewrites the whole database once and blocks writers meanwhile.
+        :type: bool
+        :return: The amount of removed chunks.
+        :type: int
+        """
+        snippet_ids = set()
+        if drop_closed:
+            snippet_ids |= self._closed_snippets()
+        if older_than is not None:
+            snippet_ids |= self._snippets_before(older_than)
+
+        chunk_ids = self._chunks_of(snippet_ids)
+        if older_than is not None:
+            chunk_ids |= self._chunks_before(older_than)
+        if keep_versions is not None:
+            chunk_ids |= self._superseded_chunks(keep_versions)
+
+        self._delete(self._chunks, self._chunks.chunk_id, chunk_ids)
+        snippet_ids |= self._prune_snippets(chunk_ids)
+        self._delete(self._snippets, self._snippets.snippet_id, snippet_ids)
+        self._delete_orphans()
+
+        print('Removed {0} chunks and {1} snippets for: {2}'.format(len(chunk_ids), len(snippet_ids), self.repo_id))
+
+        if chunk_ids:
+            self._rebuild_model(retrain)
+
+        self.vacuum(full=full_vacuum)
+
+        return len(chunk_ids)
+
+    def _pr_only(self, field):
+        # Chunks and snippets of the default branch are stored with pull request number 0
+        return ~field.endswith('-0-{0}'.format(self.repo_id))
+
+    def _closed_snippets(self):
+        query = (self._snippets
+                 .select(self._snippets.snippet_id)
+                 .where((self._snippets.merged == 0) & self._pr_only(self._snippets.snippet_id)))
+
+        return {snippet_id for snippet_id, in query.tuples()}
+
+    def _snippets_before(self, date):
+        query = (self._snippets
+                 .select(self._snippets.snippet_id)
+                 .where((self._snippets.last_mod < date) & self._pr_only(self._snippets.snippet_id)))
+
+        return {snippet_id for snippet_id, in query.tuples()}
+
+    def _chunks_of(self, snippet_ids):
+        chunk_ids = set()
+        for batch in chunked(list(snippet_ids), self.batch_size):
+            query = self._snippets.select(self._snippets.chunk_ids).where(self._snippets.snippet_id.in_(batch))
+            for blob, in query.tuples():
+                chunk_ids.update(pickle.loads(blob))
+
+        return chunk_ids
+
+    def _chunks_before(self, date):
+        query = (self._chunks
+                 .select(self._chunks.chunk_id)
+                 .where((self._chunks.last_mod < date) & self._pr_only(self._chunks.chunk_id)))
+
+        return {chunk_id for chunk_id, in query.tuples()}
+
+    def _superseded_chunks(self, keep_versions):
+        query = (self._chunks
+                 .select(self._chunks.chunk_id, self._chunks.file_path, self._chunks.name)
+                 .where(self._pr_only(self._chunks.chunk_id))
+                 .order_by(self._chunks.file_path, self._chunks.name))
+
+        # Pull requests are collected newest first, so `last_mod` would keep the versions
+        # of the oldest ones, the latest versions are those of the newest pull requests.
+        superseded = set()
+        versions = groupby(query.tuples().iterator(), key=lambda row: row[1:])
+        for _, rows in versions:
+            chunk_ids = sorted((chunk_id for chunk_id, _, _ in rows),
+                               key=lambda chunk_id: int(Chunk.pr_number(chunk_id)), reverse=True)
+            superseded.update(chunk_ids[keep_versions:])
+
+        return superseded
+
+    def _prune_snippets(self, chunk_ids):
+        """Drop removed chunks from the remaining snippets, return the snippets left without chunks."""
+        if not chunk_ids:
+            return set()
+
+        updates = {}
+        empty = set()
+        query = self._snippets.select(self._snippets.snippet_id, self._snippets.chunk_ids)
+        for snippet_id, blob in query.tuples().iterator():
+            ids = pickle.loads(blob)
+            kept = [chunk_id for chunk_id in ids if chunk_id not in chunk_ids]
+            if not kept:
+                empty.add(snippet_id)
+            elif len(kept) != len(ids):
+                updates[snippet_id] = kept
+
+        for batch in chunked(list(updates.items()), self.batch_size):
+            with self._snippets._meta.database.atomic():
+                for snippet_id, kept in batch:
+                    (self._snippets
+                     .update(chunk_ids=pickle.dumps(kept, pickle.HIGHEST_PROTOCOL))
+                     .where(self._snippets.snippet_id == snippet_id)
+                     .execute())
+
+        return empty
+
+    def _delete_orphans(self):
+        orphan_bodies = (self._bodies
+                         .select(self._bodies.body_hash)
+                         .join(self._chunks, JOIN.LEFT_OUTER,
+                               on=(self._bodies.body_hash == self._chunks.body_hash))
+                         .where(self._chunks.id.is_null()))
+        self._delete(self._bodies, self._bodies.body_hash, {h for h, in orphan_bodies.tuples()})
+
+        pr_numbers = {int(Snippet.pr_number(snippet_id))
+                      for snippet_id, in self._snippets.select(self._snippets.snippet_id).tuples()}
+        reviews = self._reviews.select(self._reviews.comment_id, self._reviews.pr_number)
+        orphan_reviews = {comment_id for comment_id, pr_number in reviews.tuples() if pr_number not in pr_numbers}
+        self._delete(self._reviews, self._reviews.comment_id, orphan_reviews)
+
+    def _delete(self, model, key, values):
+        for batch in chunked(list(values), self.batch_size):
+            with model._meta.database.atomic():
+                model.delete().where(key.in_(batch)).execute()
+
+    def _rebuild_model(self, retrain):
+        model_dir = self.path if self.path is not None else os.path.dirname(self._chunks._meta.database.database)
+        if not os.path.isfile(os.path.join(model_dir, 'd2v.model')):
+            return
+
+        if not retrain:
+            print('Model still contains removed chunks, retrain it for: {0}'.format(self.repo_id))
+            return
+
+        from .trainer import SnippetTrainer
+
+        SnippetTrainer(self.repo_id, path=self.path).train(force=True, path=self.path)
+
+    def vacuum(self, full=False):
+        repo = registry.repo(self.repo_id, path=self.path)
+
+        databases = {repo.db_name(store): repo.database(store) for store in registered_stores()
+                     if os.path.isfile(os.path.join(repo.db_dir, repo.db_name(store)))}
+        for db_name, db in databases.items():
+            if full:
+                db.pragma('auto_vacuum', 'incremental')
+                db.execute_sql('VACUUM')
+            elif db.pragma('auto_vacuum') == 2:
+                # Free pages in small steps, so readers are never blocked for long
+                while db.pragma('freelist_count'):
+                    db.execute_sql('PRAGMA incremental_vacuum({0})'.format(self.vacuum_pages)).fetchall()
+
+            db.execute_sql('ANALYZE')
+            print('Vacuumed and analyzed {0} for: {1}'.format(db_name, self.repo_id))
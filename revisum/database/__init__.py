@@ -0,0 +1,95 @@
+import time
+
+from peewee import chunked, fn
+
+# Older SQLite versions only allow this many bound variables per query
+SQLITE_MAX_VARIABLES = 999
+
+# Version of the per-repository database schemas, stored as the SQLite user_version.
+# Databases created before versioning report 0 and are treated as version 1.
+SCHEMA_VERSION = 3
+
+
+def schema_version(db):
+    return db.pragma('user_version') or 1
+
+
+def migrate_schema(db, migrations):
+    """
+    Bring a database up to the current schema version.
+
+    :param db: The initialized peewee database.
+    :param migrations: Migration functions by the schema version they upgrade to.
+    :type: dict
+    :return: The schema version the database was at before migrating.
+    :type: int
+    """
+    version = schema_version(db)
+
+    for target in sorted(v for v in migrations if v > version):
+        with db.atomic():
+            migrations[target]()
+        db.pragma('user_version', target)
+        print('Migrated {0} to schema version {1}'.format(db.database, target))
+
+    return version
+
+
+def upsert_many(model, rows, key):
+    """
+    Insert or update rows of a model within a single transaction.
+
+    :param model: The peewee model to write to.
+    :param rows: The rows to write, as dicts of field name and value.
+    :type: list
+    :param key: The unique field used to detect existing rows.
+    :return: The amount of rows written per second.
+    :type: float
+    """
+    if not rows:
+        return 0.0
+
+    preserve = [getattr(model, name) for name in rows[0] if name != key.name]
+    batch_size = max(1, SQLITE_MAX_VARIABLES // len(rows[0]))
+
+    started = time.perf_counter()
+    with model._meta.database.atomic():
+        for batch in chunked(rows, batch_size):
+            (model
+             .insert_many(batch)
+             .on_conflict(conflict_target=[key], preserve=preserve)
+             .execute())
+    elapsed = time.perf_counter() - started
+
+    return len(rows) / elapsed if elapsed else float(len(rows))
+
+
+def add_index(model, *columns):
+    """Add an index on columns of an existing table, unless it exists already."""
+    table = model._meta.table_name
+    index_name = '_'.join((table,) + columns)
+    model._meta.database.execute_sql('CREATE INDEX IF NOT EXISTS "{0}" ON "{1}" ({2})'.format(
+        index_name, table, ', '.join('"{0}"'.format(column) for column in columns)))
+
+
+def add_unique_index(model, field):
+    """
+    Add a unique index on an existing table, dropping duplicate rows first.
+
+    Only the most recently inserted row is kept for every duplicated value.
+    """
+    db = model._meta.database
+    table = model._meta.table_name
+
+    index_name = '{0}_{1}'.format(table, field.column_name)
+    if any(index.name == index_name for index in db.get_indexes(table)):
+        return
+
+    with db.atomic():
+        newest = (model
+                  .select(fn.MAX(model._meta.primary_key))
+                  .group_by(field))
+        model.delete().where(model._meta.primary_key.not_in(newest)).execute()
+        db.execute_sql('CREATE UNIQUE INDEX "{0}" ON "{1}" ("{2}")'.format(index_name, table, field.column_name))
+
+    print('Added unique index {0}'.format(index_name))
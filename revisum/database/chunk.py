@@ -1,60 +1,107 @@
-import os.path
-
-from ..utils import get_project_root
+import pickle
+from hashlib import sha1
 
+from lz4.frame import decompress
 from peewee import (
-    SqliteDatabase,
     DateTimeField,
     BlobField,
     Model,
     CharField,
-    IntegerField
+    IntegerField,
+    chunked
 )
+from playhouse.migrate import SqliteMigrator, migrate as run_migrations
 
-
-db = SqliteDatabase(None)
+from . import SQLITE_MAX_VARIABLES, add_index, add_unique_index
+from .registry import Store, register, registry
 
 
 def maybe_init(repo_id, path=None):
-    if path is not None:
-        db_dir = path
-    else:
-        db_dir = os.path.join(get_project_root(), 'data', str(repo_id))
-    if not os.path.isdir(db_dir):
-        os.makedirs(db_dir)
+    return registry.model(repo_id, Chunk, path=path)
+
+
+def maybe_init_bodies(repo_id, path=None):
+    return registry.model(repo_id, Body, path=path)
+
+
+def hash_body(lines):
+    """Content hash of the normalized lines of a chunk body."""
+    text = '\n'.join(line.rstrip() for line in lines)
+    return sha1(text.encode('utf-8')).hexdigest()
+
+
+def _migrate_v2(db, chunk, body):
+    columns = [column.name for column in db.get_columns('chunk')]
+    if 'tokens' not in columns:
+        migrator = SqliteMigrator(db)
+        run_migrations(migrator.add_column('chunk', 'tokens', chunk.tokens))
+
+    add_unique_index(chunk, chunk.chunk_id)
+    add_index(chunk, 'sloc', 'complexity', 'cognitive')
 
-    db_name = 'chunks.db'
-    db_path = os.path.join(db_dir, db_name)
-    db.init(db_path, pragmas={
-        'journal_mode': 'wal',
-        'cache_size': -1 * 64000,  # 64MB
-        'foreign_keys': 1,
-        'ignore_check_constraints': 0,
-        'synchronous': 0})
 
-    if not os.path.isfile(db_path):
-        create()
-        print('Chunks database created for: {0}'.format(repo_id))
+def _migrate_v3(db, chunk, body):
+    body.create_table(safe=True)
 
+    columns = [column.name for column in db.get_columns('chunk')]
+    if 'body_hash' not in columns:
+        migrator = SqliteMigrator(db)
+        run_migrations(
+            migrator.add_column('chunk', 'body_hash', chunk.body_hash),
+            migrator.drop_not_null('chunk', 'body'),
+        )
+    add_index(chunk, 'body_hash')
 
-def create():
-    db.create_tables([Chunk])
+    # Move the inline bodies into the content-addressed body table
+    inline_ids = [c.id for c in chunk.select(chunk.id).where(chunk.body_hash.is_null())]
+    for batch in chunked(inline_ids, 500):
+        bodies = {}
+        hashes = []
+        for c in chunk.select(chunk.id, chunk.body, chunk.tokens).where(chunk.id.in_(batch)):
+            body_hash = hash_body(pickle.loads(decompress(c.body)))
+            bodies.setdefault(body_hash, {'body_hash': body_hash, 'body': c.body, 'tokens': c.tokens})
+            hashes.append((c.id, body_hash))
+
+        for rows in chunked(list(bodies.values()), SQLITE_MAX_VARIABLES // 3):
+            body.insert_many(rows).on_conflict_ignore().execute()
+        for chunk_id, body_hash in hashes:
+            chunk.update(body_hash=body_hash, body=None, tokens=None).where(chunk.id == chunk_id).execute()
+
+    if inline_ids:
+        print('Moved {0} chunk bodies to the body table'.format(len(inline_ids)))
 
 
 class Chunk(Model):
 
-    chunk_id = CharField()
+    chunk_id = CharField(unique=True)
     sha1_hash = CharField()
     name = CharField()
     no = IntegerField()
     file_path = CharField()
     start = IntegerField()
     end = IntegerField()
-    body = BlobField()
+    # Inline bodies of chunks saved before schema version 3
+    body = BlobField(null=True)
+    tokens = BlobField(null=True)
+    body_hash = CharField(null=True, index=True)
     last_mod = DateTimeField()
     sloc = IntegerField()
     complexity = IntegerField()
     cognitive = IntegerField()
 
     class Meta:
-        database = db
+        indexes = (
+            # Covers the metrics scan of `Metrics.from_chunks`
+            (('sloc', 'complexity', 'cognitive'), False),
+        )
+
+
+class Body(Model):
+    """Chunk bodies stored once per content hash."""
+
+    body_hash = CharField(unique=True)
+    body = BlobField()
+    tokens = BlobField(null=True)
+
+
+store = register(Store('Chunks', 'chunks.db', [Chunk, Body], migrations={2: _migrate_v2, 3: _migrate_v3}))
@@ -0,0 +1,31 @@
+from .registry import Store, register, registry
+
+from peewee import (
+    BooleanField,
+    Model, CharField,
+    DateTimeField,
+    IntegerField
+)
+
+
+def maybe_init(repo_id, path=None):
+    return registry.model(repo_id, PullJob, path=path)
+
+
+class PullJob(Model):
+
+    pr_number = IntegerField(unique=True)
+    merged = BooleanField()
+    head_sha = CharField()
+    # One of `PullQueue.states`
+    state = CharField()
+    last_mod = DateTimeField()
+
+    class Meta:
+        indexes = (
+            # Used by `PullQueue.unfinished`
+            (('state', 'id'), False),
+        )
+
+
+store = register(Store('Queue', 'queue.db', [PullJob]))
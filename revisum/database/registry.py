@@ -0,0 +1,249 @@
+import os
+import threading
+from collections import OrderedDict
+
+from peewee import SqliteDatabase
+
+from . import SCHEMA_VERSION, migrate_schema
+from ..utils import get_project_root
+
+
+pragmas = {
+    # Only takes effect for new databases, must come before anything is written
+    'auto_vacuum': 'incremental',
+    'journal_mode': 'wal',
+    'cache_size': -1 * 64000,  # 64MB
+    'foreign_keys': 1,
+    'ignore_check_constraints': 0,
+    'synchronous': 0,
+}
+
+# Single database file holding all stores of a consolidated repository
+consolidated_name = 'revisum.db'
+
+_stores = OrderedDict()
+
+
+def repo_dir(repo_id):
+    return os.path.join(get_project_root(), 'data', str(repo_id))
+
+
+def bind(model, database):
+    """Subclass a model so it reads from and writes to the given database."""
+    meta = type('Meta', (), {'database': database, 'table_name': model._meta.table_name})
+    return type(model.__name__, (model,), {'Meta': meta, '__module__': model.__module__})
+
+
+class Store(object):
+    """
+    Models of a repository that are kept in one database file.
+
+    :param name: Human readable name of the store.
+    :param db_name: Name of the database file when not consolidated.
+    :param models: The unbound peewee models of the store.
+    :param migrations: Migration functions by the schema version they upgrade to,
+        called with the database and the bound models.
+    """
+
+    def __init__(self, name, db_name, models, migrations=None):
+        self.name = name
+        self.db_name = db_name
+        self.models = models
+        self.migrations = migrations or {}
+
+
+def register(store):
+    _stores[store.db_name] = store
+    return store
+
+
+def registered_stores():
+    # Stores register themselves when imported
+    from . import chunk, metrics, queue, review, snippet, state  # noqa: F401
+    return list(_stores.values())
+
+
+def store_of(model):
+    for store in registered_stores():
+        if model in store.models:
+            return store
+
+    raise ValueError('No store registered for: {0}'.format(model.__name__))
+
+
+class RepoDatabases(object):
+    """The databases and bound models of a single repository."""
+
+    def __init__(self, repo_id, db_dir, consolidated):
+        self.repo_id = repo_id
+        self.db_dir = db_dir
+        self.consolidated = consolidated
+        self._lock = threading.RLock()
+        self._databases = OrderedDict()
+        self._models = {}
+
+        os.makedirs(db_dir, exist_ok=True)
+
+    def db_name(self, store):
+        return consolidated_name if self.consolidated else store.db_name
+
+    def model(self, model):
+        bound = self._models.get(model)
+        if bound is None:
+            with self._lock:
+                if model not in self._models:
+                    self._open(store_of(model))
+                bound = self._models[model]
+
+        return bound
+
+    def database(self, store):
+        self.model(store.models[0])
+        return self._databases[self.db_name(store)]
+
+    def _open(self, store):
+        db_name = self.db_name(store)
+        db_path = os.path.join(self.db_dir, db_name)
+        stores = [s for s in registered_stores() if self.db_name(s) == db_name]
+
+        is_new = not os.path.isfile(db_path)
+        db = SqliteDatabase(db_path, pragmas=pragmas)
+        bound = {s: [bind(model, db) for model in s.models] for s in stores}
+
+        if is_new:
+            db.create_tables([model for s in stores for model in bound[s]])
+            db.pragma('user_version', SCHEMA_VERSION)
+            for s in stores:
+                print('{0} database created for: {1}'.format(s.name, self.repo_id))
+        else:
+            migrate_schema(db, self._migrations(stores, db, bound))
+            # Stores added after the database was created, e.g. in a consolidated database
+            missing = [model for s in stores for model in bound[s] if not model.table_exists()]
+            if missing:
+                db.create_tables(missing)
+
+        self._databases[db_name] = db
+        for s in stores:
+            self._models.update(zip(s.models, bound[s]))
+
+    @staticmethod
+    def _migrations(stores, db, bound):
+        versions = sorted({version for s in stores for version in s.migrations})
+
+        def migration(version):
+            def run():
+                for s in stores:
+                    if version in s.migrations:
+                        s.migrations[version](db, *bound[s])
+            return run
+
+        return {version: migration(version) for version in versions}
+
+    def close(self):
+        with self._lock:
+            for db in self._databases.values():
+                # Only the connection of the calling thread can be closed,
+                # connections of other threads are closed once released.
+                if not db.is_closed() and not db.in_transaction():
+                    db.close()
+
+
+class Registry(object):
+    """
+    Thread-safe registry of the open databases of many repositories.
+
+    The least recently used repositories are closed once more than `max_open`
+    of them are in use. When `consolidate` is set, new repositories keep all
+    their stores in a single database file.
+    """
+
+    def __init__(self, max_open=16, consolidate=False):
+        self.max_open = max_open
+        self.consolidate = consolidate
+        self._repos = OrderedDict()
+        self._lock = threading.Lock()
+
+    def repo(self, repo_id, path=None):
+        key = (str(repo_id), path)
+
+        with self._lock:
+            repo = self._repos.get(key)
+            if repo is None:
+                db_dir = path if path is not None else repo_dir(repo_id)
+                consolidated = self.consolidate or os.path.isfile(os.path.join(db_dir, consolidated_name))
+                repo = self._repos[key] = RepoDatabases(repo_id, db_dir, consolidated)
+
+                while len(self._repos) > self.max_open:
+                    _, evicted = self._repos.popitem(last=False)
+                    evicted.close()
+            else:
+                self._repos.move_to_end(key)
+
+        return repo
+
+    def model(self, repo_id, model, path=None):
+        return self.repo(repo_id, path=path).model(model)
+
+    def _after_fork(self):
+        # Connections of the parent process must not be used by a forked child
+        self._lock = threading.Lock()
+        self._repos = OrderedDict()
+
+    def close(self, repo_id=None, path=None):
+        with self._lock:
+            if repo_id is not None:
+                repos = [self._repos.pop((str(repo_id), path), None)]
+            else:
+                repos = list(self._repos.values())
+                self._repos.clear()
+
+        for repo in repos:
+            if repo is not None:
+                repo.close()
+
+
+registry = Registry()
+os.register_at_fork(after_in_child=registry._after_fork)
+
+
+def consolidate(repo_id, path=None):
+    """
+    Move the separate database files of a repository into a single one.
+
+    The separate files are kept with a `.bak` suffix.
+    """
+    db_dir = path if path is not None else repo_dir(repo_id)
+    if os.path.isfile(os.path.join(db_dir, consolidated_name)):
+        print('Databases already consolidated for: {0}'.format(repo_id))
+        return
+
+    registry.close(repo_id, path=path)
+
+    # Bring the separate files up to the current schema first
+    separate = Registry().repo(repo_id, path=db_dir)
+    stores = [s for s in registered_stores() if os.path.isfile(os.path.join(db_dir, s.db_name))]
+    for store in stores:
+        separate.database(store)
+    separate.close()
+
+    consolidated = Registry(consolidate=True).repo(repo_id, path=db_dir)
+    for store in stores:
+        db = consolidated.database(store)
+        db.execute_sql('ATTACH DATABASE ? AS source', (os.path.join(db_dir, store.db_name),))
+        try:
+            with db.atomic():
+                for model in store.models:
+                    columns = ', '.join('"{0}"'.format(f.column_name) for f in model._meta.sorted_fields)
+                    db.execute_sql('INSERT INTO main."{0}" ({1}) SELECT {1} FROM source."{0}"'.format(
+                        model._meta.table_name, columns))
+        finally:
+            db.execute_sql('DETACH DATABASE source')
+    consolidated.close()
+
+    for store in stores:
+        for suffix in ('', '-wal', '-shm'):
+            db_path = os.path.join(db_dir, store.db_name + suffix)
+            if os.path.isfile(db_path):
+                os.rename(db_path, db_path + '.bak')
+
+    print('Consolidated {0} databases for: {1}'.format(len(stores), repo_id))
@@ -1,45 +1,27 @@
-import os.path
+from . import add_index, add_unique_index
+from .registry import Store, register, registry
 
-from ..utils import get_project_root
 from peewee import (
     BooleanField,
-    SqliteDatabase,
     Model, CharField,
     FloatField,
     IntegerField
 )
 
 
-db = SqliteDatabase(None)
+def maybe_init(repo_id, path=None):
+    return registry.model(repo_id, Review, path=path)
 
 
-def maybe_init(repo_id):
-    path = get_project_root()
-    db_dir = os.path.join(path, 'data', str(repo_id))
-    if not os.path.isdir(db_dir):
-        os.makedirs(db_dir)
-
-    db_name = 'reviews.db'
-    db_path = os.path.join(db_dir, db_name)
-    db.init(db_path, pragmas={
-        'journal_mode': 'wal',
-        'cache_size': -1 * 64000,  # 64MB
-        'foreign_keys': 1,
-        'ignore_check_constraints': 0,
-        'synchronous': 0})
-
-    if not os.path.isfile(db_path):
-        create()
-        print('Reviews database created for: {0}'.format(repo_id))
-
-
-def create():
-    db.create_tables([Review])
+def _migrate_v2(db, review):
+    add_unique_index(review, review.comment_id)
+    add_index(review, 'repo_id', 'pr_merged', 'pr_number')
+    add_index(review, 'pr_number', 'repo_id')
 
 
 class Review(Model):
 
-    comment_id = IntegerField()
+    comment_id = IntegerField(unique=True)
     pr_number = IntegerField()
     pr_merged = BooleanField()
     repo_id = IntegerField()
@@ -50,4 +32,12 @@ class Review(Model):
     body = CharField()
 
     class Meta:
-        database = db
+        indexes = (
+            # Covers `Review.newest_merged`
+            (('repo_id', 'pr_merged', 'pr_number'), False),
+            # Used by `Review.load`
+            (('pr_number', 'repo_id'), False),
+        )
+
+
+store = register(Store('Reviews', 'reviews.db', [Review], migrations={2: _migrate_v2}))
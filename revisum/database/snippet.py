@@ -1,45 +1,26 @@
-import os.path
+from . import add_index, add_unique_index
+from .registry import Store, register, registry
 
-from ..utils import get_project_root
 from peewee import (
-    SqliteDatabase, Model, BlobField,
+    Model, BlobField,
     BooleanField, CharField, DateTimeField,
     IntegerField
 )
 
 
-db = SqliteDatabase(None)
-
-
 def maybe_init(repo_id, path=None):
-    if path is not None:
-        db_dir = path
-    else:
-        db_dir = os.path.join(get_project_root(), 'data', str(repo_id))
-    if not os.path.isdir(db_dir):
-        os.makedirs(db_dir)
-
-    db_name = 'snippets.db'
-    db_path = os.path.join(db_dir, db_name)
-    db.init(db_path, pragmas={
-        'journal_mode': 'wal',
-        'cache_size': -1 * 64000,  # 64MB
-        'foreign_keys': 1,
-        'ignore_check_constraints': 0,
-        'synchronous': 0})
+    return registry.model(repo_id, Snippet, path=path)
 
-    if not os.path.isfile(db_path):
-        create()
-        print('Snippets database created for: {0}'.format(repo_id))
 
-
-def create():
-    db.create_tables([Snippet])
+def _migrate_v2(db, snippet):
+    add_unique_index(snippet, snippet.snippet_id)
+    add_index(snippet, 'merged', 'last_mod')
+    add_index(snippet, 'last_mod')
 
 
 class Snippet(Model):
 
-    snippet_id = CharField()
+    snippet_id = CharField(unique=True)
     merged = BooleanField()
     last_mod = DateTimeField()
     start = IntegerField()
@@ -49,4 +30,11 @@ class Snippet(Model):
     chunk_ids = BlobField()
 
     class Meta:
-        database = db
+        indexes = (
+            # Used by `Snippet.load_all` with and without `merged_only`
+            (('merged', 'last_mod'), False),
+            (('last_mod',), False),
+        )
+
+
+store = register(Store('Snippets', 'snippets.db', [Snippet], migrations={2: _migrate_v2}))
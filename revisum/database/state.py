@@ -0,0 +1,22 @@
+from .registry import Store, register, registry
+
+from peewee import (
+    Model, CharField,
+    DateTimeField,
+    TextField
+)
+
+
+def maybe_init(repo_id, path=None):
+    return registry.model(repo_id, State, path=path)
+
+
+class State(Model):
+
+    key = CharField(unique=True)
+    # JSON encoded
+    value = TextField()
+    last_mod = DateTimeField()
+
+
+store = register(Store('State', 'state.db', [State]))
@@ -0,0 +1,70 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class Fetcher(object):
+    """
+    Pooled keep-alive HTTP session with a bounded pool of worker threads.
+
+    Requests submitted together run concurrently, so fetching the files of a
+    pull request costs about one round trip instead of one per file.
+    """
+
+    def __init__(self, max_workers=8, timeout=30):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._session = None
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+
+        return self._session
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+        return self._executor
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.get(url, **kwargs)
+
+    def submit(self, func, *args, **kwargs):
+        return self.executor.submit(func, *args, **kwargs)
+
+    def _after_fork(self):
+        # Threads and pooled connections are not inherited by forked processes
+        self._lock = threading.Lock()
+        self._session = None
+        self._executor = None
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+fetcher = Fetcher()
+os.register_at_fork(after_in_child=fetcher._after_fork)
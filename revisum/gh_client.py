@@ -0,0 +1,256 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.adapters import DEFAULT_RETRIES, HTTPAdapter
+
+from github import Github
+from github.Requester import HTTPRequestsConnectionClass, HTTPSRequestsConnectionClass, Requester
+
+
+class RateBudget(object):
+    """
+    Remaining GitHub API rate limit, as reported by the last response.
+
+    Once fewer than `reserve` requests are left, requests are spread evenly
+    over the time until the limit resets instead of running into it.
+    """
+
+    def __init__(self, reserve=500):
+        self.reserve = reserve
+        self.remaining = None
+        self.limit = None
+        self.reset = None
+        self._lock = threading.Lock()
+
+    def update(self, headers):
+        # Search and GraphQL have limits of their own
+        if headers.get('x-ratelimit-resource', 'core') != 'core':
+            return
+        if 'x-ratelimit-remaining' not in headers or 'x-ratelimit-reset' not in headers:
+            return
+
+        with self._lock:
+            self.remaining = int(float(headers['x-ratelimit-remaining']))
+            self.limit = int(float(headers.get('x-ratelimit-limit', 0)))
+            self.reset = int(float(headers['x-ratelimit-reset']))
+
+    def delay(self):
+        with self._lock:
+            if self.remaining is None or self.remaining >= self.reserve:
+                return 0
+
+            left = self.reset - time.time()
+            if left <= 0:
+                return 0
+            if self.remaining <= 0:
+                return left
+
+            return left / self.remaining
+
+    def wait(self):
+        delay = self.delay()
+        if delay:
+            print('Rate limit: {0} requests left, waiting {1:.1f}s'.format(self.remaining, delay))
+            time.sleep(delay)
+
+
+class _CachedResponse(object):
+    """Mimics the response of a connection with a body served from the ETag cache."""
+
+    def __init__(self, headers, text):
+        self.status = 200
+        self.headers = headers
+        self._text = text
+
+    def getheaders(self):
+        return self.headers.items()
+
+    def read(self):
+        return self._text
+
+
+class _ConditionalRequests(object):
+    """
+    Sends GET requests with the ETag of their last response.
+
+    Unchanged resources are answered with 304, which does not count against
+    the rate limit, and are served from memory instead.
+    """
+
+    def request(self, verb, url, input, headers, stream=False):
+        self._etag_key = None
+        self._cached = None
+        # Streamed responses are read by the caller, they are never cached
+        if verb == 'GET' and not stream:
+            self._etag_key = (self.host, url, headers.get('Authorization'))
+            self._cached = github_client.etags.get(self._etag_key)
+            if self._cached:
+                headers['If-None-Match'] = self._cached[0]
+
+        github_client.budget.wait()
+        if stream:
+            super().request(verb, url, input, headers, stream)
+        else:
+            # Older PyGithub connections take no `stream` argument
+            super().request(verb, url, input, headers)
+
+    def getresponse(self):
+        response = super().getresponse()
+        headers = {key.lower(): value for key, value in response.getheaders()}
+        github_client.budget.update(headers)
+
+        if self._etag_key is None:
+            return response
+
+        if response.status == 304 and self._cached:
+            github_client.etags.hit()
+            _, cached_headers, text = self._cached
+            return _CachedResponse(dict(cached_headers, **headers), text)
+
+        if response.status == 200 and 'etag' in headers:
+            github_client.etags.put(self._etag_key, (headers['etag'], headers, response.read()))
+
+        return response
+
+    def close(self):
+        # The pooled session is shared by all connections
+        pass
+
+
+class _HTTPConnection(_ConditionalRequests, HTTPRequestsConnectionClass):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = github_client.http
+
+
+class _HTTPSConnection(_ConditionalRequests, HTTPSRequestsConnectionClass):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = github_client.http
+
+
+class ETagCache(object):
+    """
+    Last responses of GET requests with their ETag, least recently used are dropped first.
+
+    The cache is bounded by the number of entries and the size of their bodies.
+    """
+
+    def __init__(self, max_entries=4096, max_size=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        entry_size = len(entry[2])
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[2])
+            if entry_size > self.max_size:
+                return
+
+            self._entries[key] = entry
+            self.size += entry_size
+            while len(self._entries) > self.max_entries or self.size > self.max_size:
+                _, dropped = self._entries.popitem(last=False)
+                self.size -= len(dropped[2])
+
+    def hit(self):
+        with self._lock:
+            self.hits += 1
+
+
+class GithubClient(object):
+    """
+    Process-wide GitHub client.
+
+    All PyGithub sessions share one pooled HTTP session, conditional requests
+    and the rate limit budget. Repositories are looked up once per process.
+    """
+
+    def __init__(self, pool_size=16):
+        self.pool_size = pool_size
+        self.etags = ETagCache()
+        self.budget = RateBudget()
+        self._http = None
+        self._sessions = {}
+        self._repos = {}
+        self._lock = threading.Lock()
+
+    @property
+    def http(self):
+        if self._http is None:
+            with self._lock:
+                if self._http is None:
+                    http = requests.Session()
+                    # Authentication is set per request by PyGithub, never fall back to .netrc
+                    http.auth = Requester.noopAuth if hasattr(Requester, 'noopAuth') else None
+                    # Retry as PyGithub's own connections do, e.g. waiting out secondary rate limits
+                    retry = getattr(Github, 'default_retry', None)
+                    adapter = HTTPAdapter(max_retries=retry if retry is not None else DEFAULT_RETRIES,
+                                          pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                    http.mount('https://', adapter)
+                    http.mount('http://', adapter)
+                    self._http = http
+
+        return self._http
+
+    def session(self, token=''):
+        """
+        Get the PyGithub session of an access token.
+
+        :param token: The access token, anonymous if empty.
+        :type: str
+        :return: The session.
+        :type: Github object
+        """
+        with self._lock:
+            session = self._sessions.get(token)
+            if session is None:
+                Requester.injectConnectionClasses(_HTTPConnection, _HTTPSConnection)
+                session = self._sessions[token] = Github(token) if token else Github()
+
+        return session
+
+    def get_repo(self, repo, token=''):
+        """
+        Get a repository by its ID or full name, looked up once per process.
+
+        :param repo: The repository ID or full name.
+        :return: The repository.
+        :type: Repository object
+        """
+        repository = self._repos.get((token, str(repo)))
+        if repository is None:
+            repository = self.session(token).get_repo(repo)
+            with self._lock:
+                self._repos[(token, str(repository.id))] = repository
+                self._repos[(token, repository.full_name)] = repository
+                self._repos[(token, str(repo))] = repository
+
+        return repository
+
+    def _after_fork(self):
+        # Connections of the parent process must not be used by a forked child
+        self._lock = threading.Lock()
+        self._http = None
+
+
+github_client = GithubClient()
+os.register_at_fork(after_in_child=github_client._after_fork)
@@ -0,0 +1,202 @@
+import json
+import os
+import threading
+from datetime import datetime
+from hashlib import sha1
+
+from .fetcher import fetcher
+
+pulls_query = '''
+query($owner: String!, $name: String!, $first: Int!, $after: String) {
+  repository(owner: $owner, name: $name) {
+    pullRequests(first: $first, after: $after, orderBy: {field: UPDATED_AT, direction: DESC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        number title state merged mergedAt updatedAt headRefOid
+        reviews(first: 100) {
+          nodes { databaseId body state author { __typename login ...AuthorId } }
+        }
+        comments(first: 100) {
+          nodes { databaseId body author { __typename login ...AuthorId } }
+        }
+        files(first: 100) {
+          totalCount
+          nodes { path additions changeType }
+        }
+      }
+    }
+  }
+}
+
+fragment AuthorId on Actor {
+  ... on User { databaseId }
+  ... on Bot { databaseId }
+}
+'''
+
+# Recordings are keyed by the name of their query, bump its version whenever
+# a change of the query changes its results.
+query_names = {
+    pulls_query: 'pulls/2',
+}
+
+
+class GraphQLException(Exception):
+    pass
+
+
+class GraphQLTransport(object):
+    """Sends queries to the GitHub GraphQL API, which requires an access token."""
+    url = 'https://api.github.com/graphql'
+
+    def __init__(self, token):
+        self.token = token
+
+    def execute(self, query, variables):
+        response = fetcher.session.post(self.url, json={'query': query, 'variables': variables},
+                                        headers={'Authorization': 'bearer {0}'.format(self.token)},
+                                        timeout=fetcher.timeout)
+        if not response:
+            raise GraphQLException('GraphQL request failed: {0} {1}'.format(response.status_code, response.text))
+
+        return response.json()
+
+
+class RecordedTransport(object):
+    """
+    Answers queries with recorded responses, for working offline.
+
+    Responses are stored by the name of their query and its variables in a JSON file.
+    With a live `transport`, unknown queries are sent and their responses recorded.
+    `fixtures/graphql/pulls.json` holds a synthetic response for `octocat/Hello-World`.
+    """
+
+    def __init__(self, path, transport=None):
+        self.path = path
+        self.transport = transport
+        self._lock = threading.Lock()
+        self._recordings = {}
+        if os.path.isfile(path):
+            with open(path, encoding='utf-8') as f:
+                self._recordings = json.load(f)
+
+    @staticmethod
+    def key(query, variables):
+        name = query_names.get(query) or sha1(query.encode('utf-8')).hexdigest()
+        return '{0} {1}'.format(name, json.dumps(variables, sort_keys=True))
+
+    def execute(self, query, variables):
+        key = self.key(query, variables)
+        if key in self._recordings:
+            return self._recordings[key]
+
+        if self.transport is None:
+            raise GraphQLException('No recorded response for: {0}'.format(variables))
+
+        result = self.transport.execute(query, variables)
+        with self._lock:
+            self._recordings[key] = result
+            with open(self.path, 'w', encoding='utf-8') as f:
+                json.dump(self._recordings, f, indent=1, sort_keys=True)
+
+        return result
+
+
+def _parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ')
+
+
+class _User(object):
+
+    def __init__(self, author):
+        author = author or {'__typename': 'Ghost', 'login': 'ghost'}
+        self.id = author.get('databaseId') or 0
+        # The REST API reports bots with this suffix
+        self.login = author['login'] + '[bot]' if author['__typename'] == 'Bot' else author['login']
+
+
+class _Comment(object):
+
+    def __init__(self, node):
+        self.id = node['databaseId']
+        self.body = node['body']
+        self.state = node.get('state')
+        self.user = _User(node['author'])
+
+
+class _File(object):
+    # GraphQL has no patches, the changes are read from the diff
+    patch = None
+    previous_filename = None
+
+    def __init__(self, node):
+        self.filename = node['path']
+        self.additions = node['additions']
+        # Named as by the REST API
+        self.status = 'removed' if node['changeType'] == 'DELETED' else node['changeType'].lower()
+
+
+class _Head(object):
+
+    def __init__(self, sha):
+        self.sha = sha
+
+
+class GraphQLPull(object):
+    """
+    Pull request of a GraphQL page, a stand-in for the PyGithub pull request.
+
+    Holds everything `PullRequest` needs apart from the diff and the changed files,
+    so no further API requests are made for it.
+    """
+
+    def __init__(self, repo_name, node):
+        self.number = node['number']
+        self.title = node['title']
+        self.state = 'open' if node['state'] == 'OPEN' else 'closed'
+        self.merged = node['merged']
+        self.merged_at = _parse_date(node['mergedAt']) if node['mergedAt'] else None
+        self.updated_at = _parse_date(node['updatedAt'])
+        self.head = _Head(node['headRefOid'])
+        self.diff_url = 'https://github.com/{0}/pull/{1}.diff'.format(repo_name, self.number)
+        self._reviews = [_Comment(review) for review in node['reviews']['nodes']]
+        self._comments = [_Comment(comment) for comment in node['comments']['nodes']]
+        files = node.get('files')
+        # Pull requests with more files are not listed completely
+        self._files = None
+        if files and files['totalCount'] == len(files['nodes']):
+            self._files = [_File(changed_file) for changed_file in files['nodes']]
+
+    def get_reviews(self):
+        return self._reviews
+
+    def get_issue_comments(self):
+        return self._comments
+
+    def get_files(self):
+        return self._files
+
+
+def graphql_pulls(repo_name, transport, page_size=50):
+    """
+    Yield the pull requests of a repository, most recently updated first.
+
+    Every page of pull requests is fetched together with their reviews and comments
+    in a single query.
+    """
+    owner, name = repo_name.split('/', 1)
+    after = None
+
+    while True:
+        variables = {'owner': owner, 'name': name, 'first': page_size, 'after': after}
+        result = transport.execute(pulls_query, variables)
+        if result.get('errors'):
+            raise GraphQLException('GraphQL query failed: {0}'.format(result['errors']))
+
+        pulls = result['data']['repository']['pullRequests']
+        for node in pulls['nodes']:
+            yield GraphQLPull(repo_name, node)
+
+        if not pulls['pageInfo']['hasNextPage']:
+            return
+        after = pulls['pageInfo']['endCursor']
@@ -0,0 +1,190 @@
+import io
+import re
+import subprocess
+from datetime import datetime
+
+from .pull_request import PullRequest
+from .utils import norm_path
+
+# Subject of the merge commits GitHub creates for merged pull requests
+_merge_subject = re.compile(r'^Merge pull request #(\d+)')
+
+
+class LocalRepositoryException(Exception):
+    pass
+
+
+class LocalRepository(object):
+    """Reads trees, blobs and diffs of a local git clone."""
+
+    def __init__(self, path):
+        self.path = str(path)
+
+    def git(self, *args):
+        try:
+            result = subprocess.run(['git', '-C', self.path] + list(args),
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        except subprocess.CalledProcessError as e:
+            raise LocalRepositoryException('git {0} failed: {1}'.format(args[0], e.stderr.decode('utf-8').strip()))
+
+        return result.stdout
+
+    def default_branch(self):
+        return self.git('symbolic-ref', '--short', 'HEAD').decode('utf-8').strip()
+
+    def tree(self, ref):
+        """
+        Yield the files of a commit.
+
+        :return: The blob sha, size and path of every file.
+        :type: tuple
+        """
+        output = self.git('ls-tree', '-r', '-l', '-z', ref)
+        for entry in output.split(b'\0'):
+            if not entry:
+                continue
+
+            info, path = entry.split(b'\t', 1)
+            _, object_type, sha, size = info.split()
+            if object_type == b'blob':
+                yield sha.decode('utf-8'), int(size), path.decode('utf-8')
+
+    def blobs(self, shas):
+        """Yield the content of many blobs, read by a single git process."""
+        process = subprocess.Popen(['git', '-C', self.path, 'cat-file', '--batch'],
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        try:
+            for sha in shas:
+                process.stdin.write('{0}\n'.format(sha).encode('utf-8'))
+                process.stdin.flush()
+
+                header = process.stdout.readline().split()
+                if len(header) != 3:
+                    raise LocalRepositoryException('Unknown blob: {0}'.format(sha))
+
+                content = process.stdout.read(int(header[2]))
+                process.stdout.read(1)
+                yield content
+        finally:
+            process.stdin.close()
+            process.wait()
+
+    def file(self, ref, path):
+        try:
+            return self.git('show', '{0}:{1}'.format(ref, path))
+        except LocalRepositoryException:
+            return
+
+    def diff_lines(self, base, head):
+        """Yield the lines of the diff of a head against its merge base with `base`, while git writes them."""
+        process = subprocess.Popen(['git', '-C', self.path, 'diff', '{0}...{1}'.format(base, head)],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            for line in io.TextIOWrapper(process.stdout, encoding='utf-8', errors='replace', newline=''):
+                yield line
+        finally:
+            process.stdout.close()
+            stderr = process.stderr.read()
+            process.stderr.close()
+            process.wait()
+
+        if process.returncode:
+            raise LocalRepositoryException('git diff failed: {0}'.format(stderr.decode('utf-8').strip()))
+
+    def is_ancestor(self, ref, other):
+        try:
+            self.git('merge-base', '--is-ancestor', ref, other)
+        except LocalRepositoryException:
+            return False
+        return True
+
+    def pulls(self, branch):
+        """
+        Get the pull requests of the clone, most recently updated first.
+
+        Merged pull requests are found by the merge commits on the branch, others by
+        `refs/pull/<number>/head`, which is only fetched when configured for the remote.
+        Pull requests closed without merge can not be told apart from open ones.
+        """
+        pulls = {}
+
+        output = self.git('log', '--first-parent', '--merges', '-z', '--format=%H %P %ct%n%s', branch)
+        for entry in output.decode('utf-8').split('\0'):
+            if not entry:
+                continue
+
+            line, subject = entry.split('\n', 1)
+            fields = line.split()
+            # The first parent is the branch, the second one the head of the pull request
+            base, head, timestamp = fields[1], fields[2], fields[-1]
+            match = _merge_subject.match(subject)
+            if match:
+                number = int(match.group(1))
+                updated = datetime.utcfromtimestamp(int(timestamp))
+                pulls[number] = LocalPull(self.path, number, subject, True, updated, head, base)
+
+        output = self.git('for-each-ref', '--format=%(refname) %(objectname) %(committerdate:unix)', 'refs/pull/')
+        for line in output.decode('utf-8').splitlines():
+            ref, head, timestamp = line.split()
+            parts = ref.split('/')
+            if len(parts) != 4 or parts[3] != 'head' or int(parts[2]) in pulls:
+                continue
+
+            number = int(parts[2])
+            merged = self.is_ancestor(head, branch)
+            updated = datetime.utcfromtimestamp(int(timestamp))
+            pulls[number] = LocalPull(self.path, number, ref, merged, updated, head, branch)
+
+        return sorted(pulls.values(), key=lambda pull: pull.updated_at, reverse=True)
+
+
+class _Head(object):
+
+    def __init__(self, sha):
+        self.sha = sha
+
+
+class LocalPull(object):
+    """Pull request of a local clone, a stand-in for the PyGithub pull request."""
+
+    def __init__(self, repo_path, number, title, merged, updated_at, head_sha, base):
+        self.repo_path = repo_path
+        self.number = number
+        self.title = title
+        self.merged = merged
+        self.state = 'closed' if merged else 'open'
+        self.merged_at = updated_at if merged else None
+        self.updated_at = updated_at
+        self.head = _Head(head_sha)
+        self.base = base
+        self.diff_url = None
+
+    def get_reviews(self):
+        # Reviews only exist on GitHub
+        return []
+
+    def get_issue_comments(self):
+        return []
+
+    def get_files(self):
+        # The diff is read from the clone, there is nothing to save by listing the files
+        return None
+
+
+class LocalPullRequest(PullRequest):
+    """Pull request read from a local clone, without any network requests."""
+
+    def __init__(self, repo_id, pr_number, repo_name=None, pr_head_sha=None, pull=None):
+        super().__init__(repo_id, pr_number, repo_name, pr_head_sha, pull=pull)
+        self._local = LocalRepository(pull.repo_path)
+
+    def _diff_lines(self):
+        if self._patch_content is not None:
+            return iter(self._patch_content.splitlines(True))
+
+        return self._local.diff_lines(self.pull.base, self.head_sha)
+
+    def _fetch_file(self, path):
+        content = self._local.file(self.head_sha, norm_path(path))
+        if content is not None:
+            return content.decode('utf-8', errors='replace')
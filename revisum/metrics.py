@@ -6,8 +6,8 @@ from radon.complexity import cc_visit_ast
 from radon.raw import analyze
 from sortedcontainers import SortedList
 
-from .database.chunk import maybe_init as maybe_init_chunks, Chunk as DataChunk
-from .database.metrics import maybe_init, Metrics as DataMetrics
+from .database.chunk import maybe_init as maybe_init_chunks
+from .database.metrics import maybe_init
 
 
 class MetricsException(Exception):
@@ -35,6 +35,12 @@ class Metrics(object):
             self.complexity
             self.cognitive
 
+    def __getstate__(self):
+        # The syntax tree is only needed to compute the metrics
+        state = self.__dict__.copy()
+        state['_ast_node'] = None
+        return state
+
     def to_json(self):
         metrics = OrderedDict()
         metrics['rating'] = self.rating
@@ -118,7 +124,7 @@ class Metrics(object):
             return self._db_data[metric][int(th) - 1]
 
     def from_chunks(self):
-        maybe_init_chunks(self.repo_id)
+        DataChunk = maybe_init_chunks(self.repo_id)
 
         db_metrics = {}
         data = DataChunk.select(DataChunk.sloc, DataChunk.complexity,
@@ -129,7 +135,7 @@ class Metrics(object):
         self._db_data = db_metrics
 
     def from_db(self):
-        maybe_init(self.repo_id)
+        DataMetrics = maybe_init(self.repo_id)
 
         query = DataMetrics.select().namedtuples()
         thresholds = OrderedDict()
@@ -151,7 +157,7 @@ class Metrics(object):
         return round(sum(ratings) / metrics_count, 2)
 
     def save(self):
-        maybe_init(self.repo_id)
+        DataMetrics = maybe_init(self.repo_id)
         print('Saving metrics for: {0}...'.format(self.repo_id))
 
         for metric in self._metrics:
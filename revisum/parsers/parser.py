@@ -1,23 +1,88 @@
+import io
 from abc import ABC, abstractmethod
+from bisect import bisect_right
 
 from pygments import lex
 from pygments.lexers import PythonLexer
+from pygments.token import Token
 
 from ..chunk import Chunk, ChunkException
 from ..snippet import Snippet
-from ..utils import reverse_enum, norm_path
+from ..utils import norm_path
+
+
+class FileIndex(object):
+    """
+    Lines of a file with their tokens, lexed once for all hunks of the file.
+
+    `heads` are the lines starting a function or class, every hunk is resolved
+    to the closest one by bisection. The boundaries met by parsing forward from
+    a head are kept in `scans`, so hunks of the same function share its chunks.
+    """
+
+    def __init__(self, lines, is_head):
+        self.lines = lines
+        self.scans = {}
+        self._lexer = PythonLexer()
+        self._tokens = [None] * len(lines)
+
+        definitions = self._definitions()
+        self.heads = [i for i in definitions if is_head(self.line_tokens(i))]
+        self.functions = {i for i in definitions if self._has_function(i)}
+        self._heads = set(self.heads)
+
+    def _definitions(self):
+        """Get the lines that may define a function or class, in order."""
+        return range(1, len(self.lines) + 1)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def line_tokens(self, line):
+        line_tokens = self._tokens[line - 1]
+        if line_tokens is None:
+            line_tokens = self._tokens[line - 1] = list(lex(self.lines[line - 1], self._lexer))
+
+        return line_tokens
+
+    def _has_function(self, line):
+        return any(token[0] == Token.Name.Function for token in self.line_tokens(line))
+
+    def is_head(self, line):
+        return line in self._heads
+
+    def head_before(self, line):
+        """Get the last line starting a function or class at or before `line`, or None."""
+        pos = bisect_right(self.heads, line) - 1
+        if pos >= 0:
+            return self.heads[pos]
+
+
+class _Scan(object):
+    """Forward parse from a line, continued where it stopped by later hunks."""
+
+    def __init__(self, start):
+        self.line = start
+        # Line of every boundary, with the span of the chunk it completes or None
+        self.boundaries = []
+        self.state = ([], False, None, None)
+        self.done = False
+
+    def passed(self, stop):
+        return self.done or (stop is not None and self.boundaries and self.boundaries[-1][0] > stop)
 
 
 class FileParser(ABC):
 
-    def __init__(self, pr_number, repo_id, file_path, file_name=None, raw_file=None):
+    def __init__(self, pr_number, repo_id, file_path, file_name=None, raw_file=None, content=None):
         self.pr_number = pr_number
         self.repo_id = repo_id
         self._file_name = file_name
         self._raw_file = raw_file
+        self._content = content
         self._file_path = str(file_path)
-        self._file_len = None
-        self._chunks = []
+        self._index = None
+        self._taken = set()
         self._chunks_count = 1
 
         self._reset()
@@ -26,17 +91,26 @@ class FileParser(ABC):
     def f(self):
         if self._raw_file:
             f = self._raw_file.iter_lines(decode_unicode=True)
+        elif self._content is not None:
+            f = io.StringIO(self._content)
         else:
             f = open(self._file_path, encoding='utf-8')
 
         return f
 
     @property
-    def file_len(self):
-        if self._file_len is None:
-            self._file_len = len(list(self.f))
+    def index(self):
+        if self._index is None:
+            self._index = self._make_index([line.rstrip('\n') for line in self.f])
 
-        return self._file_len
+        return self._index
+
+    def _make_index(self, lines):
+        return FileIndex(lines, self.is_func_or_class)
+
+    @property
+    def file_len(self):
+        return len(self.index)
 
     @property
     def file_path(self):
@@ -48,11 +122,12 @@ class FileParser(ABC):
     @property
     def chunk_name(self):
         if not self._chunk_name:
-            second_token = self._snippet_body[0][0][1]
+            head = self.index.line_tokens(self._snippet_body[0])
+            second_token = head[0][1]
             if second_token.strip() == '':
-                self._chunk_name = self._snippet_body[0][3][1]
+                self._chunk_name = head[3][1]
             else:
-                self._chunk_name = self._snippet_body[0][2][1]
+                self._chunk_name = head[2][1]
 
         return self._chunk_name
 
@@ -75,25 +150,15 @@ class FileParser(ABC):
 
     def _reset(self, soft=False):
         self._chunk_name = ''
+        # Line numbers, lexed once the chunk is made
         self._snippet_body = []
+        self._snippet_functions = False
         self._snippet_start = None
         self._snippet_end = None
         if not soft:
             self._hunk_no = 0
             self._file_no = 0
 
-    def _read(self, start=None):
-        for i, line in enumerate(self.f, 1):
-            if start is not None and i < start:
-                continue
-            yield i, line.rstrip('\n')
-
-    def _read_reverse(self, start=None):
-        for i, line in reverse_enum(self.f, 1):
-            if start is not None and i > start:
-                continue
-            yield i, line.rstrip('\n')
-
     def _is_complete(self):
         if all([self._snippet_body, self._snippet_start, self._snippet_end]):
             return True
@@ -103,36 +168,20 @@ class FileParser(ABC):
         return self.is_func_or_class(line_tokens) and self._is_next_chunk(line_tokens[0])
 
     def parse(self, file_no=None, start=None, stop=None):
-            if file_no:
-                self._file_no = file_no
+        if file_no:
+            self._file_no = file_no
 
-            for i, line in self._read(start=start):
-                line_tokens = list(lex(line, PythonLexer()))
+        chunks = []
+        for i, span in self._boundaries(start or 1, stop):
+            if span is not None:
+                chunk = self._make_chunk(span)
+                if chunk:
+                    chunks.append(chunk)
 
-                if self._is_next_chunk(line_tokens):
-                    if self._is_complete():
-                        self._make_chunk()
+            if stop is not None and i > stop:
+                break
 
-                    if stop is not None and i > stop:
-                        break
-
-                    if self.is_func_or_class(line_tokens):
-                        self._snippet_body.append(line_tokens)
-                        self._snippet_start = i
-                    elif self._snippet_body:
-                        self._snippet_body.append(line_tokens)
-
-                elif self._snippet_body:
-                    self._snippet_body.append(line_tokens)
-                    self._snippet_end = i
-
-            if self._snippet_body and self._is_complete():
-                self._make_chunk()
-
-            chunks = self._chunks
-            self._chunks = []
-
-            return chunks
+        return chunks
 
     def parse_single(self, hunk_no, file_no, start, stop):
         start = self.chunk_start(start)
@@ -140,39 +189,85 @@ class FileParser(ABC):
 
         self._hunk_no = hunk_no
         self._file_no = file_no
-        self._snippet_start = start
-        self._snippet_end = stop
 
-        for i, line in self._read_reverse(start=start):
-            line_tokens = list(lex(line, PythonLexer()))
+        head = self.index.head_before(start)
+        if head is not None:
+            return self.parse(start=head, stop=stop)
 
-            if self.is_func_or_class(line_tokens):
-                self._snippet_body.append(line_tokens)
-                self._snippet_start = i
+    def _boundaries(self, start, stop):
+        """
+        Get the chunk boundaries of a forward parse from `start`, up to the first one after `stop`.
 
-                if self._is_complete():
-                    self._reset(soft=True)
-                    return self.parse(start=i, stop=stop)
-            else:
-                self._snippet_body.append(line_tokens)
+        :return: The line of every boundary and the span of the chunk it completes, if any.
+        :type: list
+        """
+        scan = self.index.scans.get(start)
+        if scan is None:
+            scan = self.index.scans[start] = _Scan(start)
+
+        if not scan.passed(stop):
+            self._continue(scan, stop)
+
+        return scan.boundaries
+
+    def _continue(self, scan, stop):
+        self._snippet_body, self._snippet_functions, self._snippet_start, self._snippet_end = scan.state
+        index = self.index
+
+        while scan.line <= len(index):
+            i = scan.line
+            scan.line += 1
+
+            if not self._snippet_body or self._is_next_chunk(index.line_tokens(i)):
+                scan.boundaries.append((i, self._take_span() if self._is_complete() else None))
+
+                if index.is_head(i):
+                    self._append(i)
+                    self._snippet_start = i
+                elif self._snippet_body:
+                    self._append(i)
+
+                if stop is not None and i > stop:
+                    break
+
+            elif self._snippet_body:
+                self._append(i)
                 self._snippet_end = i
+        else:
+            if self._snippet_body and self._is_complete():
+                scan.boundaries.append((float('inf'), self._take_span()))
+            scan.done = True
+
+        scan.state = (self._snippet_body, self._snippet_functions, self._snippet_start, self._snippet_end)
+        self._reset(soft=True)
+
+    def _append(self, line):
+        self._snippet_body.append(line)
+        if line in self.index.functions:
+            self._snippet_functions = True
 
-    def _make_chunk(self):
+    def _take_span(self):
         self._rm_last_line()
+        body = [self.index.line_tokens(i) for i in self._snippet_body]
+        span = (self.chunk_name, self._snippet_start, self._snippet_end, body)
+        self._reset(soft=True)
+
+        return span
+
+    def _make_chunk(self, span):
+        name, start, end, body = span
+        # Hunks of the same function resolve to the same span
+        if (start, end) in self._taken:
+            return
+        self._taken.add((start, end))
 
         try:
             chunk_id = Chunk.make_id(self._chunks_count, self.snippet_id)
-            chunk = Chunk(
-                chunk_id, self.chunk_name, self._chunks_count, self.file_path,
-                self._snippet_body, self._snippet_start, self._snippet_end
-            )
-
-            self._chunks.append(chunk)
+            chunk = Chunk(chunk_id, name, self._chunks_count, self.file_path, body, start, end)
             self._chunks_count += 1
+            return chunk
         except ChunkException as e:
-            print('Skipping invalid chunk: {0}, {1}\n{2}'.format(self.snippet_id, self.chunk_name, e))
-
-        self._reset(soft=True)
+            print('Skipping invalid chunk: {0}, {1}\n{2}'.format(self.snippet_id, name, e))
 
     @abstractmethod
     def is_func_or_class(self, line_tokens):
@@ -1,9 +1,162 @@
+import ast
+import warnings
+from bisect import bisect_left, bisect_right
+from itertools import islice
+
 from pygments.token import Token
 
-from .parser import FileParser
+from .parser import FileIndex, FileParser
+
+
+class AstFileIndex(FileIndex):
+    """
+    Index of a file whose functions, classes and decorators are found by its syntax tree.
+
+    Chunks are found by jumping from a head to the lines that may end it: the
+    definitions and decorators at the line numbers of the tree, and the lines
+    starting with a name or a comment in the first column. The lines in between
+    are never looked at, and only lexed once they are part of a chunk.
+    """
+
+    def __init__(self, lines, is_head, tree):
+        self._tree = tree
+        super().__init__(lines, is_head)
+        # Only the line numbers are needed, the many nodes would slow down garbage collection
+        self._tree = None
+        # The boundaries and the span of the chunk of every head, found once
+        self.chunks = {}
+        self._sorted_functions = sorted(self.functions)
+
+    def _definitions(self):
+        definitions = set()
+        decorators = set()
+        # Definitions are statements, expressions are never visited
+        nodes = list(self._tree.body)
+        while nodes:
+            node = nodes.pop()
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                definitions.add(node.lineno)
+                decorators.update(decorator.lineno for decorator in node.decorator_list)
+
+            for field in ('body', 'orelse', 'finalbody', 'handlers', 'cases'):
+                nodes.extend(getattr(node, field, ()))
+
+        first_column = {i for i, line in enumerate(self.lines, 1) if line[:1] == '#' or line[:1].isidentifier()}
+        self.ends = sorted(definitions | decorators | first_column)
+
+        return sorted(definitions)
+
+    def ends_after(self, line):
+        """Get the lines after `line` that may end a chunk, in order."""
+        return islice(self.ends, bisect_right(self.ends, line), None)
+
+    def head_after(self, line):
+        """Get the first line starting a function or class at or after `line`, or None."""
+        pos = bisect_left(self.heads, line)
+        if pos < len(self.heads):
+            return self.heads[pos]
+
+    def has_function(self, start, stop):
+        """Whether a function is defined from line `start` up to, but not including, `stop`."""
+        pos = bisect_left(self._sorted_functions, start)
+        return pos < len(self._sorted_functions) and self._sorted_functions[pos] < stop
 
 
 class PythonFileParser(FileParser):
+    # Find chunks by lexing every line ('lines') or by the syntax tree of the file ('ast')
+    engine = 'lines'
+
+    def __init__(self, pr_number, repo_id, file_path, file_name=None, raw_file=None, content=None, engine=None):
+        super().__init__(pr_number, repo_id, file_path, file_name=file_name, raw_file=raw_file, content=content)
+        if engine:
+            self.engine = engine
+
+    def _make_index(self, lines):
+        if self.engine == 'ast':
+            source = '\n'.join(lines)
+            # Line numbers of the tree only match for lines separated by `\n`
+            if '\r' not in source.replace('\r\n', ''):
+                try:
+                    with warnings.catch_warnings():
+                        warnings.simplefilter('ignore')
+                        tree = ast.parse(source)
+                    return AstFileIndex(lines, self.is_func_or_class, tree)
+                except (SyntaxError, ValueError, RecursionError, MemoryError):
+                    # E.g. Python 2 files, parsed line by line instead
+                    pass
+
+        return super()._make_index(lines)
+
+    def _boundaries(self, start, stop):
+        if isinstance(self.index, AstFileIndex):
+            return self._jump_boundaries(start)
+
+        return super()._boundaries(start, stop)
+
+    def _jump_boundaries(self, start):
+        """
+        Yield the boundaries of a forward parse from `start`, chunk by chunk.
+
+        Lines before a head are left out, they are no part of any chunk.
+        """
+        index = self.index
+        head = index.head_after(start)
+        if head is not None:
+            yield head, None
+
+        while head is not None:
+            chunk = index.chunks.get(head)
+            if chunk is None:
+                chunk = index.chunks[head] = self._find_chunk(head)
+
+            boundaries, end = chunk
+            yield from boundaries
+            if end is None:
+                return
+
+            head = end if index.is_head(end) else index.head_after(end)
+            if head is not None and head != end:
+                yield head, None
+
+    def _find_chunk(self, head):
+        """
+        Find the chunk starting at a head, as parsing line by line would.
+
+        :return: The boundaries met until the chunk is complete and the line
+            ending it, None if it reaches the end of the file.
+        :type: tuple
+        """
+        index = self.index
+        self._reset(soft=True)
+        self._snippet_body = [head]
+        self._snippet_start = head
+        boundaries = []
+        last = head
+
+        for i in index.ends_after(head):
+            self._snippet_functions = index.has_function(head, i)
+            if not self._is_next_chunk(index.line_tokens(i)):
+                continue
+
+            if i > last + 1:
+                self._snippet_body = list(range(head, i))
+                self._snippet_end = i - 1
+                boundaries.append((i, self._take_span()))
+                return boundaries, i
+
+            # Without a line in between the chunk is not complete and goes on
+            if index.is_head(i):
+                self._snippet_start = i
+            boundaries.append((i, None))
+            last = i
+
+        if last < len(index):
+            self._snippet_body = list(range(head, len(index) + 1))
+            self._snippet_end = len(index)
+            boundaries.append((float('inf'), self._take_span()))
+        self._reset(soft=True)
+
+        return boundaries, None
 
     def is_func_or_class(self, line_tokens):
         if len(line_tokens) > 2 and line_tokens[0][0] == Token.Keyword:
@@ -28,14 +181,10 @@ class PythonFileParser(FileParser):
         if first_line_tokens[0][1] == '\n':
             return False
 
-        first_body_type = self._snippet_body[0][2]
+        head = self.index.line_tokens(self._snippet_body[0])
+        first_body_type = head[2]
         if first_body_type[0] == Token.Name.Class:
-            func_in_class = (x[0] for b in self._snippet_body for x in b)
-            count = 0
-            for func in func_in_class:
-                if func == Token.Name.Function:
-                    count += 1
-            if count < 1:
+            if not self._snippet_functions:
                 return False
 
         first_token_type = [token[0] for token in first_line_tokens[0:4]]
@@ -44,7 +193,7 @@ class PythonFileParser(FileParser):
 
         if Token.Name.Function in first_token_type or Token.Name.Class in first_token_type:
 
-            first_token = self._snippet_body[0][0]
+            first_token = head[0]
             # Detect indentation level of current chunk
             if first_token[0] == Token.Text and first_token[1].strip() == '':
                 first_token_len = len(first_token[1])
@@ -72,7 +221,8 @@ class PythonFileParser(FileParser):
     def _rm_last_line(self):
         should_rm = False
 
-        tokens_text = [token[1] for token in self._snippet_body[-1][0:2]]
+        last_line = self.index.line_tokens(self._snippet_body[-1])
+        tokens_text = [token[1] for token in last_line[0:2]]
         # Remove empty lines
         if tokens_text[0] == '\n':
             should_rm = True
@@ -81,7 +231,7 @@ class PythonFileParser(FileParser):
         if any(token.startswith('#') for token in tokens_text):
             should_rm = True
 
-        tokens_type = [token[0] for token in self._snippet_body[-1][0:2]]
+        tokens_type = [token[0] for token in last_line[0:2]]
         # Remove decorators
         if Token.Name.Decorator in tokens_type:
             should_rm = True
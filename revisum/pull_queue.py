@@ -0,0 +1,74 @@
+from datetime import datetime
+
+from .pull_request import PullRequest
+from .database import upsert_many
+from .database.queue import maybe_init
+
+
+def process_pull(repo_id, repo_name, pr_number, head_sha, pull=None, pull_request_class=PullRequest):
+    """
+    Fetch and parse a pull request in a worker process.
+
+    :param pull: The pull request fetched by GraphQL or read from a clone, if any.
+    :type: GraphQLPull or LocalPull object
+    :param pull_request_class: The class of the pull request to create.
+    :return: The snippets and reviews of the pull request, or None if it has no supported snippets.
+    :type: tuple
+    """
+    pull_request = pull_request_class(repo_id, pr_number, repo_name, head_sha, pull=pull)
+    if not pull_request.supported_snippets:
+        return
+
+    for snippet in pull_request.snippets:
+        for chunk in snippet.chunks:
+            # Hash the body in the worker, the writer only has to serialize it
+            chunk.body_hash
+
+    return pull_request.snippets, pull_request.valid_reviews
+
+
+class PullQueue(object):
+    """
+    Durable queue of the pull requests to collect for a repository.
+
+    Pull requests are enqueued in the order they are listed. Jobs left
+    unfinished by an interrupted collection are handed out again first.
+    """
+    states = ('pending', 'done', 'skipped', 'failed')
+
+    def __init__(self, repo_id, path=None):
+        self.repo_id = repo_id
+        self._jobs = maybe_init(repo_id, path=path)
+
+    def put(self, pr_number, merged, head_sha):
+        row = {
+            'pr_number': pr_number,
+            'merged': merged,
+            'head_sha': head_sha,
+            'state': 'pending',
+            'last_mod': datetime.now(),
+        }
+        upsert_many(self._jobs, [row], self._jobs.pr_number)
+
+    def unfinished(self):
+        query = (self._jobs
+                 .select(self._jobs.pr_number, self._jobs.merged, self._jobs.head_sha)
+                 .where(self._jobs.state == 'pending')
+                 .order_by(self._jobs.id))
+
+        return list(query.tuples())
+
+    def finish(self, pr_number, state):
+        (self._jobs
+         .update(state=state, last_mod=datetime.now())
+         .where(self._jobs.pr_number == pr_number)
+         .execute())
+
+    def discard(self, pr_numbers):
+        """Forget pending jobs that were enqueued, but will not be collected."""
+        pr_numbers = list(pr_numbers)
+        if pr_numbers:
+            (self._jobs
+             .delete()
+             .where(self._jobs.pr_number.in_(pr_numbers) & (self._jobs.state == 'pending'))
+             .execute())
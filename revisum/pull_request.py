@@ -1,10 +1,16 @@
-import requests
+import io
+from collections import deque
+from itertools import chain
 
 from unidiff import PatchSet
+from unidiff.errors import UnidiffParseError
 
+from .cache import diff_key, file_cache, raw_file_key
+from .chunk import Chunk
+from .fetcher import fetcher
 from .snippet import Snippet
 from .review import Review
-from .utils import gh_session, norm_path
+from .utils import gh_repo, norm_path
 from .parsers.python_parser import PythonFileParser
 
 
@@ -12,10 +18,11 @@ class PullRequest(object):
     ignored_bots = ['codecov-io', 'renovate[bot]', 'deepcode[bot]',
                     'coveralls']
 
-    def __init__(self, repo_id, pr_number, repo_name=None, pr_head_sha=None):
+    def __init__(self, repo_id, pr_number, repo_name=None, pr_head_sha=None, pull=None):
         self._repo = None
-        self._pull = None
+        self._pull = pull
         self._patch_content = None
+        self._changed_files = None
         self._valid_reviews = []
         self._snippets = []
 
@@ -65,34 +72,150 @@ class PullRequest(object):
         return False
 
     def _make_snippets(self):
-        patch = PatchSet(self.patch_content)
-
-        for file_no, change in enumerate(patch, 1):
-            if not self.is_supported(change.target_file):
+        # Resolved once here instead of in every fetching thread
+        self.repo_name, self.head_sha
+
+        # Every file is fetched as soon as its changes are read and parsed once it
+        # is fetched, while the rest of the diff is still being downloaded. At most
+        # as many files as the fetcher has workers are held at once.
+        pending = deque()
+        for file_no, change in self._supported_changes():
+            while len(pending) >= fetcher.max_workers:
+                self._parse_change(*pending.popleft())
+
+            pending.append((file_no, change, fetcher.submit(self._fetch_file, change.target_file)))
+            while pending and pending[0][2].done():
+                self._parse_change(*pending.popleft())
+
+        while pending:
+            self._parse_change(*pending.popleft())
+
+    def _parse_change(self, file_no, change, content):
+        content = content.result()
+        if content is None:
+            return
+
+        parser = PythonFileParser(self.number, self.repo_id,
+                                  change.target_file, content=content)
+
+        for hunk_no, hunk in enumerate(change, 1):
+
+            start = hunk.target_start
+            stop = start + hunk.target_length - 1
+            chunks = parser.parse_single(hunk_no, file_no, start, stop)
+            if not chunks:
                 continue
 
-            snippet_url = self.change_url(change.target_file)
-            raw_snippet = requests.get(snippet_url)
-            if raw_snippet:
-                parser = PythonFileParser(self.number, self.repo_id,
-                                          change.target_file, raw_file=raw_snippet)
+            snippet_id = Snippet.make_id(hunk_no, file_no, self.number, self.repo_id)
+            snippet = Snippet(snippet_id, self.merged, chunks, change.source_file, change.target_file)
+            self._snippets.append(snippet)
 
-            for hunk_no, hunk in enumerate(change, 1):
+    def _supported_changes(self):
+        """
+        Get the changes of the supported files with their number in the diff.
 
-                start = hunk.target_start
-                stop = start + hunk.target_length - 1
-                chunks = parser.parse_single(hunk_no, file_no, start, stop)
-                if not chunks:
-                    continue
+        The changed files are listed first, pull requests without supported changes
+        are skipped without downloading anything and the changes are read from the
+        patches of the listing if possible, instead of from the whole diff.
 
-                snippet_id = Snippet.make_id(hunk_no, file_no, self.number, self.repo_id)
-                snippet = Snippet(snippet_id, self.merged, chunks, change.source_file, change.target_file)
-                self._snippets.append(snippet)
+        :return: The file numbers and changes, the diff is read while iterating.
+        :type: iterator
+        """
+        files = self.changed_files
+        if files is None:
+            return ((file_no, change) for file_no, change in enumerate(self._patched_files(), 1)
+                    if self.is_supported(change.target_file))
+
+        # Files without additions have no new code to take snippets from
+        supported = [(file_no, changed_file) for file_no, changed_file in enumerate(files, 1)
+                     if changed_file.status != 'removed' and changed_file.additions
+                     and self.is_supported(changed_file.filename)]
+        if not supported:
+            print('No supported changes for: {0} [{1}]'.format(self.title, self.number))
+            return iter([])
+
+        changes = [(file_no, self._file_change(changed_file)) for file_no, changed_file in supported]
+        if all(change is not None for _, change in changes):
+            return iter(changes)
+
+        # Patches of binary or very large files are left out of the listing, binary
+        # files are also left out of the parsed diff, so files are matched by path.
+        wanted = {changed_file.filename: file_no for file_no, changed_file in supported}
+        return ((wanted[norm_path(change.target_file)], change) for change in self._patched_files()
+                if norm_path(change.target_file) in wanted)
+
+    def _patched_files(self):
+        """Yield the changed files of the diff one by one, each once its last line is read."""
+        lines = []
+        for line in self._diff_lines():
+            if line.startswith('diff --git ') and lines:
+                yield from PatchSet(lines)
+                lines = []
+            lines.append(line)
+
+        if lines:
+            yield from PatchSet(lines)
+
+    def _diff_lines(self):
+        """Yield the lines of the diff while it is downloaded, or read from the cache."""
+        if self._patch_content is not None:
+            yield from self._patch_content.splitlines(True)
+            return
+
+        key = diff_key(self.repo_id, self.number, self.head_sha)
+        cached = file_cache.open(key)
+        if cached is not None:
+            with cached:
+                yield from cached
+            return
+
+        response = fetcher.get(self.diff_url, stream=True)
+        if not response:
+            print('Failed to download diff for: {0} [{1}]'.format(self.title, self.number))
+            return
+
+        response.raw.decode_content = True
+        lines = io.TextIOWrapper(response.raw, encoding='utf-8', errors='replace', newline='')
+        # The diff is only cached once it was read completely
+        with response, file_cache.writer(key) as cached:
+            for line in lines:
+                cached.write(line)
+                yield line
+
+    @staticmethod
+    def _file_change(changed_file):
+        """Get the change of a listed file from its patch, or None if the listing has no patch."""
+        if not changed_file.patch:
+            return
+
+        source = 'a/{0}'.format(changed_file.previous_filename or changed_file.filename)
+        if changed_file.status == 'added':
+            source = '/dev/null'
+
+        diff = '--- {0}\n+++ b/{1}\n{2}\n'.format(source, changed_file.filename, changed_file.patch.rstrip('\n'))
+        try:
+            return PatchSet(diff)[0]
+        except (UnidiffParseError, IndexError):
+            return
+
+    def _fetch_file(self, path):
+        """Get the content of a changed file at the head of the pull request, from the cache if possible."""
+        key = raw_file_key(self.repo_name, self.head_sha, norm_path(path))
+        content = file_cache.get(key)
+        if content is None:
+            response = fetcher.get(self.change_url(path))
+            if not response:
+                return
+
+            content = response.text
+            file_cache.put(key, content)
+
+        return content
 
     @property
     def repo(self):
         if not self._repo:
-            self._repo = gh_session().get_repo(self.repo_id)
+            self._repo = gh_repo(self.repo_id)
 
         return self._repo
 
@@ -109,6 +232,20 @@ class PullRequest(object):
 
         return self._pull
 
+    @property
+    def changed_files(self):
+        """
+        Get the files changed by the pull request, in the order of its diff.
+
+        :return: The changed files, or None if they can not be listed.
+        :type: list
+        """
+        if self._changed_files is None:
+            files = self.pull.get_files()
+            self._changed_files = list(files) if files is not None else None
+
+        return self._changed_files
+
     @property
     def patch_content(self):
         """
@@ -117,9 +254,8 @@ class PullRequest(object):
         :return: The content of the patch.
         :type: str
         """
-        if not self._patch_content:
-            response = requests.get(self.diff_url)
-            self._patch_content = response.text
+        if self._patch_content is None:
+            self._patch_content = ''.join(self._diff_lines())
 
         return self._patch_content
 
@@ -163,60 +299,56 @@ class PullRequest(object):
         return self._valid_reviews
 
     def _has_valid_review(self):
-        reviews = self.pull.get_reviews()
-        rev_len = reviews.totalCount
-        if rev_len > 0:
-            for comment in reviews:
-                if comment.body != '':
-                    self._valid_reviews.append(
-                        Review(self.repo_id, self.number,
-                               self.merged, body=comment.body, comment_id=comment.id,
-                               user_id=comment.user.id, user_login=comment.user.login,
-                               state=comment.state)
-                    )
-
-        if self._valid_reviews or self._closed_with_comment():
+        # Reviews and comments are fetched concurrently, iterating the paginated
+        # lists directly saves the extra request of `totalCount`.
+        reviews = fetcher.submit(list, self.pull.get_reviews())
+        comments = None
+        if not self.merged and self.state == 'closed':
+            comments = fetcher.submit(list, self.pull.get_issue_comments())
+
+        for comment in reviews.result():
+            if comment.body != '':
+                self._valid_reviews.append(
+                    Review(self.repo_id, self.number,
+                           self.merged, body=comment.body, comment_id=comment.id,
+                           user_id=comment.user.id, user_login=comment.user.login,
+                           state=comment.state)
+                )
+
+        if self._valid_reviews or (comments and self._closed_with_comment(comments.result())):
             print('Found review or comment for: {0} [{1}]'.format(self.title, self.number))
             return True
 
         print('No review found for: {0} [{1}]'.format(self.title, self.number))
         return False
 
-    def _closed_with_comment(self):
-        if not self.merged and self.state == 'closed':
-            comments = self.pull.get_issue_comments()
-            com_len = comments.totalCount
-            if com_len > 0:
-                # Skip comments that were made by these bots
-                ignored_bots = PullRequest.ignored_bots
-                for comment in comments:
-                    if comment.user.login in ignored_bots:
-                        continue
-                    self._valid_reviews.append(
-                        Review(self.repo_id, self.number, self.merged,
-                               body=comment.body, comment_id=comment.id,
-                               user_id=comment.user.id, user_login=comment.user.login,
-                               state='CLOSED')
-                    )
-                return True
+    def _closed_with_comment(self, comments):
+        if comments:
+            # Skip comments that were made by these bots
+            ignored_bots = PullRequest.ignored_bots
+            for comment in comments:
+                if comment.user.login in ignored_bots:
+                    continue
+                self._valid_reviews.append(
+                    Review(self.repo_id, self.number, self.merged,
+                           body=comment.body, comment_id=comment.id,
+                           user_id=comment.user.id, user_login=comment.user.login,
+                           state='CLOSED')
+                )
+            return True
 
         return False
 
-    def exists(self):
-        for snippet in self.snippets:
-            if snippet.exists():
-                return True
+    @staticmethod
+    def save_snippets(repo_id, snippets, reviews):
+        print('Saving snippets for: {0}...'.format(repo_id))
+        Snippet.save_many(repo_id, snippets)
+        Chunk.save_many(repo_id, chain.from_iterable(s.chunks for s in snippets))
 
-        return False
+        if snippets:
+            print('Saving reviews for: {0}...'.format(repo_id))
+            Review.save_many(repo_id, reviews)
 
     def save(self):
-        print('Saving snippets for: {0}...'.format(self.repo_id))
-        for snippet in self.snippets:
-            snippet.save()
-            for chunk in snippet.chunks:
-                chunk.save(self.repo_id)
-
-        if self.snippets:
-            print('Saving reviews for: {0}...'.format(self.repo_id))
-            for valid_review in self.valid_reviews:
-                valid_review.save()
+        reviews = self.valid_reviews if self.snippets else []
+        self.save_snippets(self.repo_id, self.snippets, reviews)
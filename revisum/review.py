@@ -1,6 +1,7 @@
 from collections import OrderedDict
 
-from .database.review import Review as DataReview, maybe_init
+from .database import upsert_many
+from .database.review import maybe_init
 
 
 class Review(object):
@@ -39,7 +40,7 @@ class Review(object):
 
     @classmethod
     def load_single(cls, repo_id, review_id):
-        maybe_init(repo_id)
+        DataReview = maybe_init(repo_id)
 
         review = DataReview.get_or_none(
             DataReview.comment_id == review_id)
@@ -52,7 +53,7 @@ class Review(object):
 
     @classmethod
     def load(cls, pr_number, repo_id):
-        maybe_init(repo_id)
+        DataReview = maybe_init(repo_id)
 
         db_reviews = DataReview.select().where(
             (DataReview.pr_number == pr_number) &
@@ -70,7 +71,7 @@ class Review(object):
 
     @classmethod
     def newest_merged(cls, repo_id):
-        maybe_init(repo_id)
+        DataReview = maybe_init(repo_id)
 
         review = (DataReview.select(DataReview.pr_number).where(
             (DataReview.repo_id == repo_id) &
@@ -81,31 +82,27 @@ class Review(object):
         if review:
             return review.pr_number
 
+    def _to_row(self):
+        return {
+            'comment_id': self.comment_id,
+            'pr_number': self.pr_number,
+            'pr_merged': self.pr_merged,
+            'repo_id': self.repo_id,
+            'state': self.state,
+            'rating': self.rating,
+            'user_id': self.user_id,
+            'user_login': self.user_login,
+            'body': self.body,
+        }
+
     def save(self):
-        maybe_init(self.repo_id)
+        DataReview = maybe_init(self.repo_id)
+        upsert_many(DataReview, [self._to_row()], DataReview.comment_id)
 
-        review = DataReview.get_or_none(comment_id=self.comment_id)
-        if review:
-            (DataReview
-             .update(comment_id=self.comment_id,
-                     pr_number=self.pr_number,
-                     pr_merged=self.pr_merged,
-                     repo_id=self.repo_id,
-                     state=self.state,
-                     rating=self.rating,
-                     user_id=self.user_id,
-                     user_login=self.user_login,
-                     body=self.body)
-             .where(DataReview.comment_id == self.comment_id)
-             .execute())
-        else:
-            (DataReview
-             .create(comment_id=self.comment_id,
-                     pr_number=self.pr_number,
-                     pr_merged=self.pr_merged,
-                     repo_id=self.repo_id,
-                     state=self.state,
-                     rating=self.rating,
-                     user_id=self.user_id,
-                     user_login=self.user_login,
-                     body=self.body))
+    @classmethod
+    def save_many(cls, repo_id, reviews):
+        DataReview = maybe_init(repo_id)
+
+        rows = [review._to_row() for review in reviews]
+        rate = upsert_many(DataReview, rows, DataReview.comment_id)
+        print('Saved {0} reviews for: {1} ({2:.0f} rows/s)'.format(len(rows), repo_id, rate))
@@ -0,0 +1,201 @@
+import io
+import os
+import pickle
+import shutil
+import struct
+from datetime import datetime
+from hashlib import sha256
+
+from lz4 import frame
+from peewee import chunked
+
+from .database import SCHEMA_VERSION, SQLITE_MAX_VARIABLES
+from .database.registry import Registry, registered_stores, registry, repo_dir
+
+# Bump whenever the layout of the records changes
+SNAPSHOT_VERSION = 1
+SNAPSHOT_FORMAT = 'revisum-snapshot'
+
+_length = struct.Struct('>I')
+
+
+class SnapshotException(Exception):
+    pass
+
+
+class _Unpickler(pickle.Unpickler):
+    """Only allows the plain values a snapshot is made of."""
+
+    def find_class(self, module, name):
+        if (module, name) == ('datetime', 'datetime'):
+            return datetime
+
+        raise SnapshotException('Unexpected type in snapshot: {0}.{1}'.format(module, name))
+
+
+class Snapshot(object):
+    """
+    Single file snapshot of everything stored for a repository.
+
+    The snapshot is an lz4 compressed stream of length-prefixed records: a header,
+    the rows of every table in batches stored column by column, the files of the
+    trained model in pieces and a trailer with the SHA-256 of all previous records.
+    Exporting and importing only ever holds one batch in memory.
+    """
+    # Rows per table batch
+    batch_size = 2000
+    # Bytes per model file piece
+    piece_size = 1024 * 1024
+
+    def __init__(self, repo_id, path=None):
+        self.repo_id = repo_id
+        self.path = path if path is not None else repo_dir(repo_id)
+
+    def export(self, file_path):
+        repo = Registry().repo(self.repo_id, path=self.path)
+        checksum = sha256()
+        rows = 0
+
+        with frame.open(file_path, 'wb') as out:
+            self._write(out, checksum, {
+                'format': SNAPSHOT_FORMAT, 'version': SNAPSHOT_VERSION,
+                'schema_version': SCHEMA_VERSION, 'repo_id': self.repo_id,
+                'created': datetime.now(),
+            })
+
+            for store in registered_stores():
+                if not os.path.isfile(os.path.join(self.path, repo.db_name(store))):
+                    continue
+
+                for unbound in store.models:
+                    model = repo.model(unbound)
+                    fields = model._meta.sorted_fields
+                    columns = [field.column_name for field in fields]
+                    query = model.select(*fields).tuples().iterator()
+
+                    batch = []
+                    for row in query:
+                        batch.append(row)
+                        if len(batch) == self.batch_size:
+                            rows += self._write_batch(out, checksum, model, columns, batch)
+                            batch = []
+                    if batch:
+                        rows += self._write_batch(out, checksum, model, columns, batch)
+
+            for file_name in self._model_files():
+                with open(os.path.join(self.path, file_name), 'rb') as f:
+                    for piece in iter(lambda: f.read(self.piece_size), b''):
+                        self._write(out, checksum, {'file': file_name, 'data': piece})
+
+            out.write(self._record({'end': True, 'sha256': checksum.hexdigest()}))
+
+        repo.close()
+        print('Exported {0} rows for: {1} to {2}'.format(rows, self.repo_id, file_path))
+
+    def _model_files(self):
+        if not os.path.isdir(self.path):
+            return []
+
+        return sorted(name for name in os.listdir(self.path) if name.startswith('d2v.model'))
+
+    def _write_batch(self, out, checksum, model, columns, batch):
+        self._write(out, checksum, {
+            'table': model._meta.table_name,
+            'columns': columns,
+            'data': [list(column) for column in zip(*batch)],
+        })
+        return len(batch)
+
+    @staticmethod
+    def _record(payload):
+        data = pickle.dumps(payload, pickle.HIGHEST_PROTOCOL)
+        return _length.pack(len(data)) + data
+
+    def _write(self, out, checksum, payload):
+        record = self._record(payload)
+        checksum.update(record)
+        out.write(record)
+
+    @classmethod
+    def read(cls, file_path):
+        """Yield the records of a snapshot, verifying its checksum at the end."""
+        checksum = sha256()
+
+        with frame.open(file_path, 'rb') as f:
+            while True:
+                head = f.read(_length.size)
+                if len(head) < _length.size:
+                    raise SnapshotException('Snapshot is truncated: {0}'.format(file_path))
+
+                data = f.read(_length.unpack(head)[0])
+                payload = _Unpickler(io.BytesIO(data)).load()
+
+                if payload.get('end'):
+                    if payload['sha256'] != checksum.hexdigest():
+                        raise SnapshotException('Snapshot checksum mismatch: {0}'.format(file_path))
+                    return
+
+                checksum.update(head + data)
+                yield payload
+
+    @classmethod
+    def load(cls, file_path, path=None, force=False):
+        """
+        Import a snapshot into the data of its repository.
+
+        The snapshot is imported next to the target directory first and only moved
+        into place once its checksum has been verified.
+        """
+        records = cls.read(file_path)
+        header = next(records)
+        if header.get('format') != SNAPSHOT_FORMAT or header.get('version') != SNAPSHOT_VERSION:
+            raise SnapshotException('Unsupported snapshot: {0}'.format(file_path))
+        if header['schema_version'] > SCHEMA_VERSION:
+            raise SnapshotException('Snapshot has a newer schema: {0}'.format(header['schema_version']))
+
+        repo_id = header['repo_id']
+        target = path if path is not None else repo_dir(repo_id)
+        if os.path.exists(target) and not force:
+            raise SnapshotException('Repository data exists already: {0}'.format(target))
+
+        staging = target.rstrip(os.sep) + '.importing'
+        shutil.rmtree(staging, ignore_errors=True)
+
+        staging_registry = Registry()
+        repo = staging_registry.repo(repo_id, path=staging)
+        models = {model._meta.table_name: model for store in registered_stores() for model in store.models}
+        rows = 0
+
+        try:
+            for record in records:
+                if 'table' in record:
+                    rows += cls._load_batch(repo.model(models[record['table']]), record)
+                elif 'file' in record:
+                    with open(os.path.join(staging, os.path.basename(record['file'])), 'ab') as f:
+                        f.write(record['data'])
+        except Exception:
+            staging_registry.close()
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+        staging_registry.close()
+        registry.close(repo_id, path=path)
+        if os.path.exists(target):
+            shutil.rmtree(target)
+        os.rename(staging, target)
+
+        print('Imported {0} rows for: {1} from {2}'.format(rows, repo_id, file_path))
+        return repo_id
+
+    @staticmethod
+    def _load_batch(model, record):
+        fields = {field.column_name: field for field in model._meta.sorted_fields}
+        known = [i for i, column in enumerate(record['columns']) if column in fields]
+        columns = [fields[record['columns'][i]] for i in known]
+        rows = list(zip(*(record['data'][i] for i in known)))
+
+        with model._meta.database.atomic():
+            for batch in chunked(rows, max(1, SQLITE_MAX_VARIABLES // len(columns))):
+                model.insert_many(batch, fields=columns).on_conflict_replace().execute()
+
+        return len(rows)
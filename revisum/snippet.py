@@ -1,12 +1,16 @@
 import pickle
 from collections import OrderedDict
 from datetime import datetime
+from itertools import chain
+
+from peewee import chunked
 
 from .chunk import Chunk
 from .review import Review
 from .tokenizer import LineTokenizer
 from .utils import norm_path
-from .database.snippet import maybe_init, Snippet as DataSnippet
+from .database import SQLITE_MAX_VARIABLES, upsert_many
+from .database.snippet import maybe_init
 
 
 class Snippet(object):
@@ -108,32 +112,35 @@ class Snippet(object):
 
         return lines
 
+    @classmethod
+    def as_tokens_and_elements(cls, code):
+        """Get the tokens of code and their types at once, lexing it a single time."""
+        if not isinstance(code, list):
+            code = [code]
+
+        tokens, elements = LineTokenizer(code).tokens_and_elements()
+
+        return list(chain.from_iterable(tokens)), list(chain.from_iterable(elements))
+
     @classmethod
     def load(cls, snippet_id, path=None):
         repo_id = cls.repo_id(snippet_id)
-        maybe_init(repo_id, path=path)
+        DataSnippet = maybe_init(repo_id, path=path)
 
         db_snippet = DataSnippet.get_or_none(snippet_id=snippet_id)
         if db_snippet:
-
-            chunks = []
             chunk_ids = pickle.loads(db_snippet.chunk_ids)
-            for chunk_id in chunk_ids:
-                chunks.append(Chunk.load(chunk_id))
-
-            merged = db_snippet.merged
-            source = db_snippet.source
-            target = db_snippet.target
+            chunks = Chunk.load_many(repo_id, chunk_ids)
 
-            snippet = cls(snippet_id, merged, chunks, source, target)
-            return snippet
+            return cls._from_data(db_snippet, chunk_ids, chunks)
 
     @classmethod
-    def load_all(cls, repo_id, merged_only=False, path=None):
-        maybe_init(repo_id, path=path)
+    def load_all(cls, repo_id, merged_only=False, path=None, page_size=500):
+        DataSnippet = maybe_init(repo_id, path=path)
 
         query = DataSnippet.select(
             DataSnippet.snippet_id,
+            DataSnippet.merged,
             DataSnippet.chunk_ids,
             DataSnippet.source,
             DataSnippet.target)
@@ -143,56 +150,123 @@ class Snippet(object):
 
         query = query.order_by(DataSnippet.last_mod.desc())
 
-        for db_snippet in query:
-            snippet_id = db_snippet.snippet_id
+        for page in chunked(query.iterator(), page_size):
+            page_chunk_ids = [pickle.loads(db_snippet.chunk_ids) for db_snippet in page]
+            # Fetch the chunks of the whole page at once
+            chunks = Chunk.load_many(repo_id, chain.from_iterable(page_chunk_ids))
 
-            chunks = []
-            chunk_ids = pickle.loads(db_snippet.chunk_ids)
-            for chunk_id in chunk_ids:
-                chunks.append(Chunk.load(chunk_id))
+            for db_snippet, chunk_ids in zip(page, page_chunk_ids):
+                snippet = cls._from_data(db_snippet, chunk_ids, chunks)
+                if snippet:
+                    print('Finished loading snippet with ID: {0}'.format(snippet.snippet_id))
+                    yield snippet
+
+    @classmethod
+    def _from_data(cls, db_snippet, chunk_ids, chunks):
+        snippet_chunks = [chunks[chunk_id] for chunk_id in chunk_ids if chunk_id in chunks]
+        if not snippet_chunks:
+            print('Skipping snippet without chunks: {0}'.format(db_snippet.snippet_id))
+            return
 
-            merged = db_snippet.merged
-            source = db_snippet.source
-            target = db_snippet.target
+        merged = db_snippet.merged
+        source = db_snippet.source
+        target = db_snippet.target
 
-            snippet = cls(snippet_id, merged, chunks, source, target)
-            print('Finished loading snippet with ID: {0}'.format(snippet_id))
-            yield snippet
+        return cls(db_snippet.snippet_id, merged, snippet_chunks, source, target)
 
     def _serialize_ids(self):
         return pickle.dumps(self.chunk_ids, pickle.HIGHEST_PROTOCOL)
 
     def exists(self):
         repo_id = self.repo_id(self.snippet_id)
-        maybe_init(repo_id)
+        DataSnippet = maybe_init(repo_id)
+
+        return DataSnippet.select(DataSnippet.id).where(DataSnippet.snippet_id == self.snippet_id).exists()
+
+    @classmethod
+    def known_pulls(cls, repo_id):
+        """
+        Get the numbers of all pull requests with stored snippets.
+
+        Loaded once per collection, so known pull requests can be skipped
+        before their diff is downloaded and parsed.
+
+        :return: The pull request numbers.
+        :type: set
+        """
+        DataSnippet = maybe_init(repo_id)
 
-        snippet = DataSnippet.get_or_none(snippet_id=self.snippet_id)
-        return bool(snippet)
+        query = DataSnippet.select(DataSnippet.snippet_id).tuples().iterator()
+        pulls = {int(cls.pr_number(snippet_id)) for snippet_id, in query}
+        # Snippets of the default branch are stored with pull request number 0
+        pulls.discard(0)
+
+        return pulls
+
+    @classmethod
+    def load_reviews(cls, snippet_id):
+        """
+        Load the reviews of a snippet without loading the snippet itself.
+
+        :return: The reviews, or None for unknown snippets.
+        :type: list
+        """
+        repo_id = cls.repo_id(snippet_id)
+        DataSnippet = maybe_init(repo_id)
+
+        if not DataSnippet.select(DataSnippet.id).where(DataSnippet.snippet_id == snippet_id).exists():
+            return
+
+        reviews = Review.load(cls.pr_number(snippet_id), repo_id)
+        return [review.to_json() for review in reviews]
+
+    def _to_row(self):
+        return {
+            'snippet_id': self.snippet_id,
+            'merged': self.merged,
+            'last_mod': datetime.now(),
+            'start': self.start,
+            'length': self.length,
+            'source': self.source_file,
+            'target': self.target_file,
+            'chunk_ids': self._serialize_ids(),
+        }
 
     def save(self):
         repo_id = self.repo_id(self.snippet_id)
-        maybe_init(repo_id)
-
-        snippet = DataSnippet.get_or_none(snippet_id=self.snippet_id)
-        if snippet:
-            (DataSnippet
-             .update(snippet_id=self.snippet_id,
-                     merged=self.merged,
-                     last_mod=datetime.now(),
-                     start=self.start,
-                     length=self.length,
-                     source=self.source_file,
-                     target=self.target_file,
-                     chunk_ids=self._serialize_ids())
-             .where(DataSnippet.snippet_id == self.snippet_id)
-             .execute())
-        else:
-            (DataSnippet
-             .create(snippet_id=self.snippet_id,
-                     merged=self.merged,
-                     last_mod=datetime.now(),
-                     start=self.start,
-                     length=self.length,
-                     source=self.source_file,
-                     target=self.target_file,
-                     chunk_ids=self._serialize_ids()))
+        DataSnippet = maybe_init(repo_id)
+
+        upsert_many(DataSnippet, [self._to_row()], DataSnippet.snippet_id)
+
+    @classmethod
+    def save_many(cls, repo_id, snippets):
+        DataSnippet = maybe_init(repo_id)
+
+        rows = [snippet._to_row() for snippet in snippets]
+        rate = upsert_many(DataSnippet, rows, DataSnippet.snippet_id)
+        print('Saved {0} snippets for: {1} ({2:.0f} rows/s)'.format(len(rows), repo_id, rate))
+
+    @classmethod
+    def delete_many(cls, repo_id, snippet_ids):
+        DataSnippet = maybe_init(repo_id)
+
+        with DataSnippet._meta.database.atomic():
+            for batch in chunked(list(snippet_ids), SQLITE_MAX_VARIABLES):
+                DataSnippet.delete().where(DataSnippet.snippet_id.in_(batch)).execute()
+
+    @classmethod
+    def branch_files(cls, repo_id):
+        """
+        Get the stored snippets of the default branch by their file.
+
+        :return: The snippet ID and chunk IDs by file path.
+        :type: dict
+        """
+        DataSnippet = maybe_init(repo_id)
+
+        query = (DataSnippet
+                 .select(DataSnippet.snippet_id, DataSnippet.target, DataSnippet.chunk_ids)
+                 .where(DataSnippet.snippet_id.endswith('-0-{0}'.format(repo_id))))
+
+        return {target: (snippet_id, pickle.loads(chunk_ids))
+                for snippet_id, target, chunk_ids in query.tuples().iterator()}
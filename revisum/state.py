@@ -0,0 +1,113 @@
+import json
+from datetime import datetime, timezone
+
+from .database import upsert_many
+from .database.state import maybe_init
+
+
+class RepoState(object):
+    """Small values a repository keeps between collections, e.g. the last collected commit."""
+
+    def __init__(self, repo_id, path=None):
+        self.repo_id = repo_id
+        self._state = maybe_init(repo_id, path=path)
+
+    def get(self, key, default=None):
+        row = self._state.select(self._state.value).where(self._state.key == key).tuples().first()
+        if row is None:
+            return default
+
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        row = {'key': key, 'value': json.dumps(value), 'last_mod': datetime.now()}
+        upsert_many(self._state, [row], self._state.key)
+
+    def delete(self, key):
+        self._state.delete().where(self._state.key == key).execute()
+
+
+def _naive_utc(date):
+    # PyGithub returns naive or aware UTC datetimes depending on its version
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+
+class PullCursor(object):
+    """
+    Position of a pull request collection, kept until the collection finishes.
+
+    After every pull request the cursor records the last one collected in listing
+    order and the ones being processed, so an interrupted collection is resumed
+    where it stopped instead of at the newest pull request.
+    """
+    key = 'pulls_cursor'
+
+    def __init__(self, repo_id, path=None):
+        self._state = RepoState(repo_id, path=path)
+        self._cursor = self._state.get(self.key)
+        self.resuming = self._cursor is not None
+        # Where the interrupted collection stopped, fixed while its pull requests are skipped
+        self._resumed = dict(self._cursor, in_flight=list(self._cursor['in_flight'])) if self.resuming else None
+
+    @property
+    def collected(self):
+        return self._cursor['collected'] if self._cursor else 0
+
+    def start(self):
+        if self._cursor is None:
+            self._cursor = {'started': datetime.utcnow().isoformat(), 'number': None, 'updated': None,
+                            'collected': 0, 'in_flight': []}
+            self._save()
+
+    def locate(self, number, updated_at):
+        """
+        Locate a listed pull request relative to where an interrupted collection stopped.
+
+        :return: 'updated' if it changed since that collection started, 'handled' if it was
+            processed before the interruption, 'in_flight' if it was being processed and
+            'ahead' if the collection did not reach it.
+        :type: str
+        """
+        resumed = self._resumed
+        updated_at = _naive_utc(updated_at)
+        if updated_at > datetime.fromisoformat(resumed['started']):
+            return 'updated'
+        if number in resumed['in_flight']:
+            return 'in_flight'
+
+        last_updated = resumed['updated']
+        if last_updated and (updated_at > datetime.fromisoformat(last_updated) or number == resumed['number']):
+            return 'handled'
+
+        return 'ahead'
+
+    def begin(self, number):
+        self._cursor['in_flight'].append(number)
+        self._save()
+
+    def advance(self, number, updated_at, collected):
+        """
+        Record a pull request as processed, `updated_at` is None if its position is unknown.
+
+        The position only moves on in listing order, pull requests updated since the
+        collection started or resumed jobs are listed before it and leave it as it is.
+        """
+        last_updated = self._cursor['updated']
+        if updated_at is not None:
+            updated_at = _naive_utc(updated_at)
+            if last_updated is None or updated_at <= datetime.fromisoformat(last_updated):
+                self._cursor['number'] = number
+                self._cursor['updated'] = updated_at.isoformat()
+        self._cursor['collected'] = collected
+        if number in self._cursor['in_flight']:
+            self._cursor['in_flight'].remove(number)
+        self._save()
+
+    def finish(self):
+        self._state.delete(self.key)
+        self._cursor = None
+
+    def _save(self):
+        self._state.set(self.key, self._cursor)
@@ -1,60 +1,134 @@
 from pygments import lex
 from pygments.lexers import PythonLexer
-from pygments.token import Token
+from pygments.token import Token, string_to_tokentype
+
+
+# Bump whenever the layout produced by `encode_lexed` changes
+LEXED_VERSION = 1
+
+# Lexers keep no state between calls, one is shared by all tokenizers
+_lexer = PythonLexer()
+
+
+class TokenizerException(Exception):
+    pass
+
+
+def encode_lexed(lexed_lines):
+    """
+    Encode lexed lines into a compact, versioned representation.
+
+    Token types are stored once per body in a lookup table, every token
+    then only refers to its type by index.
+
+    :param lexed_lines: Lines of (token type, text) pairs.
+    :type: list
+    :return: Version, token type names and lines of (type id, text) pairs.
+    :type: tuple
+    """
+    type_names = []
+    type_ids = {}
+    lines = []
+
+    for line_tokens in lexed_lines:
+        line = []
+        for token_type, text in line_tokens:
+            type_id = type_ids.get(token_type)
+            if type_id is None:
+                type_id = type_ids[token_type] = len(type_names)
+                type_names.append('.'.join(token_type))
+            line.append((type_id, text))
+        lines.append(line)
+
+    return LEXED_VERSION, type_names, lines
+
+
+def decode_lexed(encoded):
+    """
+    Decode lexed lines created by `encode_lexed`.
+
+    :param encoded: Version, token type names and lines of (type id, text) pairs.
+    :type: tuple
+    :return: Lines of (token type, text) pairs.
+    :type: list
+    """
+    version, type_names, lines = encoded
+    if version != LEXED_VERSION:
+        raise TokenizerException('Unsupported lexed version: {0}'.format(version))
+
+    token_types = [string_to_tokentype(name) for name in type_names]
+    return [[(token_types[type_id], text) for type_id, text in line] for line in lines]
 
 
 class LineTokenizer(object):
+    """
+    Tokens of lines of code without punctuation, whitespace and comments.
 
-    def __init__(self, lines):
+    Lines are lexed one by one by a shared lexer, or all at once with `whole`,
+    which is faster, but keeps strings spanning several lines in one token.
+    """
+
+    def __init__(self, lines, lexed=None, whole=False):
         self._lines = lines
-        self.exclusions = [
+        self._lexed = lexed
+        self._whole = whole
+        self.exclusions = frozenset([
             Token.Text,
             Token.Punctuation,
             Token.Comment,
             Token.Comment.Single,
-        ]
-        self.char_exclusions = [
+        ])
+        self.char_exclusions = frozenset([
             '.', '=', '"', "'",
-        ]
+        ])
 
-    @property
-    def tokens(self):
-        lexed_lines = []
+    def _lex_lines(self):
+        if self._lexed is not None:
+            return iter(self._lexed)
+        if self._whole:
+            return self._lex_whole()
 
-        for line in self._lines:
-            tokens = lex(line, PythonLexer())
-            tokens_list = []
+        return (lex(line, _lexer) for line in self._lines)
 
-            for token in tokens:
-                if token[0] in self.exclusions:
-                    continue
-                if token[1] in self.char_exclusions:
-                    continue
+    def _lex_whole(self):
+        line_tokens = []
+        for token in lex('\n'.join(self._lines), _lexer):
+            line_tokens.append(token)
+            if token[1].endswith('\n'):
+                yield line_tokens
+                line_tokens = []
 
-                tokens_list.append(token[1])
+        if line_tokens:
+            yield line_tokens
 
-            if tokens_list:
-                lexed_lines.append(tokens_list)
+    def _kept_lines(self):
+        exclusions = self.exclusions
+        char_exclusions = self.char_exclusions
 
-        return lexed_lines
+        for tokens in self._lex_lines():
+            kept = [token for token in tokens if token[0] not in exclusions and token[1] not in char_exclusions]
+            if kept:
+                yield kept
 
     @property
-    def elements(self):
-        lexed_elements = []
-
-        for line in self._lines:
-            tokens = lex(line, PythonLexer())
-            tokens_list = []
+    def tokens(self):
+        return [[token[1] for token in kept] for kept in self._kept_lines()]
 
-            for token in tokens:
-                if token[0] in self.exclusions:
-                    continue
-                if token[1] in self.char_exclusions:
-                    continue
+    @property
+    def elements(self):
+        return [[token[0] for token in kept] for kept in self._kept_lines()]
 
-                tokens_list.append(token[0])
+    def tokens_and_elements(self):
+        """
+        Get the tokens and their types, lexing every line once for both.
 
-            if tokens_list:
-                lexed_elements.append(tokens_list)
+        :return: Lines of tokens and lines of their types.
+        :type: tuple
+        """
+        tokens = []
+        elements = []
+        for kept in self._kept_lines():
+            tokens.append([token[1] for token in kept])
+            elements.append([token[0] for token in kept])
 
-        return lexed_elements
+        return tokens, elements
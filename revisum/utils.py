@@ -2,10 +2,12 @@ import os
 from base64 import urlsafe_b64decode, urlsafe_b64encode
 from pathlib import Path
 
-from github import Github
+from .gh_client import github_client
 
 
 gh_access_token = ''
+# Secret of the GitHub webhook, deliveries are not verified if empty
+gh_webhook_secret = ''
 
 
 def get_project_root():
@@ -14,11 +16,13 @@ def get_project_root():
 
 
 def gh_session():
-    """Returns a PyGithub session."""
-    if gh_access_token:
-        return Github(gh_access_token)
+    """Returns the shared PyGithub session."""
+    return github_client.session(gh_access_token)
 
-    return Github()
+
+def gh_repo(repo):
+    """Returns a repository by ID or full name, looked up once per process."""
+    return github_client.get_repo(repo, gh_access_token)
 
 
 def reverse_enum(f, start=None):
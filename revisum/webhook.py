@@ -0,0 +1,146 @@
+import hmac
+import queue
+import threading
+from hashlib import sha256
+
+from github.PullRequest import PullRequest as GithubPullRequest
+
+from .metrics import Metrics
+from .pull_queue import PullQueue, process_pull
+from .pull_request import PullRequest
+from .utils import gh_session
+
+# Events carrying the pull request they are about
+handled_events = ('pull_request', 'pull_request_review')
+
+
+class WebhookException(Exception):
+    pass
+
+
+def verify_signature(secret, body, signature):
+    """
+    Check the `X-Hub-Signature-256` header of a webhook delivery.
+
+    :param secret: The secret of the webhook.
+    :type: str
+    :param body: The raw body of the delivery.
+    :type: bytes
+    :param signature: The value of the header.
+    :type: str
+    :return: True if the body was signed with the secret.
+    :type: bool
+    """
+    expected = 'sha256=' + hmac.new(secret.encode('utf-8'), body, sha256).hexdigest()
+    return hmac.compare_digest(expected, signature or '')
+
+
+def pull_from_payload(event, payload):
+    """
+    Build the pull request of a webhook payload, without any API requests.
+
+    :param event: The `X-GitHub-Event` of the delivery.
+    :type: str
+    :param payload: The decoded payload.
+    :type: dict
+    :return: The repository ID, its full name and the pull request.
+    :type: tuple
+    """
+    if event not in handled_events:
+        raise WebhookException('Unsupported event: {0}'.format(event))
+
+    try:
+        repository = payload['repository']
+        raw_pull = dict(payload['pull_request'])
+    except (KeyError, TypeError):
+        raise WebhookException('No pull request in {0} payload'.format(event))
+
+    # Review payloads omit `merged`, which PyGithub would fetch on access
+    raw_pull.setdefault('merged', raw_pull.get('merged_at') is not None)
+    pull = gh_session().create_from_raw_data(GithubPullRequest, raw_pull)
+
+    return repository['id'], repository['full_name'], pull
+
+
+class WebhookIngester(object):
+    """
+    Collects the pull requests of webhook deliveries in a background thread.
+
+    Pull requests are put in the queue of their repository first, so deliveries
+    that were not processed before a restart are picked up by the next collection.
+    """
+
+    def __init__(self):
+        self._repos = queue.Queue()
+        self._pulls = {}
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def put(self, repo_id, repo_name, pull, background=True):
+        """
+        Queue the pull request of a delivery.
+
+        :param background: Collect it in the background, otherwise by calling `drain`.
+        :type: bool
+        """
+        PullQueue(repo_id).put(pull.number, pull.merged, pull.head.sha)
+        with self._lock:
+            self._pulls[(repo_id, pull.number)] = (repo_name, pull)
+            if not background:
+                return
+
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='webhook-ingester', daemon=True)
+                self._thread.start()
+
+        self._repos.put(repo_id)
+
+    def _run(self):
+        while True:
+            repo_id = self._repos.get()
+            try:
+                self.drain(repo_id)
+            except Exception as e:
+                print('Failed to ingest pull requests for {0}: {1!r}'.format(repo_id, e))
+
+    def drain(self, repo_id):
+        """
+        Collect the pull requests of the deliveries for a repository.
+
+        Only the pull requests queued by `put` are collected, other jobs of the queue
+        belong to collections that may still be running and are left to them.
+
+        :return: The number of collected pull requests.
+        :type: int
+        """
+        pull_queue = PullQueue(repo_id)
+        collected_count = 0
+
+        with self._lock:
+            keys = sorted(key for key in self._pulls if key[0] == repo_id)
+            delivered = [self._pulls.pop(key) for key in keys]
+
+        for repo_name, pull in delivered:
+            pr_number = pull.number
+            try:
+                collected = process_pull(repo_id, repo_name, pr_number, pull.head.sha, pull)
+            except Exception as e:
+                print('Failed to collect pull request {0}: {1!r}'.format(pr_number, e))
+                pull_queue.finish(pr_number, 'failed')
+                continue
+
+            if not collected:
+                pull_queue.finish(pr_number, 'skipped')
+                continue
+
+            PullRequest.save_snippets(repo_id, *collected)
+            pull_queue.finish(pr_number, 'done')
+            collected_count += 1
+
+        if collected_count:
+            Metrics(repo_id).save()
+
+        return collected_count
+
+
+ingester = WebhookIngester()
@@ -0,0 +1,56 @@
+import glob
+import os
+
+import pytest
+
+import revisum
+from revisum.parsers.python_parser import AstFileIndex, PythonFileParser
+
+package_dir = os.path.dirname(revisum.__file__)
+stdlib_dir = os.path.dirname(os.__file__)
+
+corpus = sorted(glob.glob(os.path.join(package_dir, '**', '*.py'), recursive=True))
+for package in ('json', 'email', 'concurrent', 'logging', 'http'):
+    corpus += sorted(glob.glob(os.path.join(stdlib_dir, package, '**', '*.py'), recursive=True))
+
+
+def spans(chunks):
+    return [(chunk.name, chunk.start, chunk.end, [[token[1] for token in line] for line in chunk._body])
+            for chunk in chunks or []]
+
+
+def parse(file_path, content, engine):
+    files = spans(PythonFileParser(0, 1, file_path, content=content, engine=engine).parse(file_no=1))
+
+    parser = PythonFileParser(1, 1, file_path, content=content, engine=engine)
+    length = content.count('\n') + 1
+    hunks = [spans(parser.parse_single(hunk_no, 1, start, start + 10))
+             for hunk_no, start in enumerate(range(1, length, 25), 1)]
+
+    return files, hunks, parser.index
+
+
+@pytest.mark.parametrize('file_path', corpus, ids=lambda file_path: os.path.relpath(file_path, stdlib_dir))
+def test_same_chunks(file_path):
+    with open(file_path, encoding='utf-8') as f:
+        content = f.read()
+
+    files, hunks, lines_index = parse(file_path, content, 'lines')
+    ast_files, ast_hunks, index = parse(file_path, content, 'ast')
+
+    assert isinstance(index, AstFileIndex)
+    if set(lines_index.heads) - set(index.heads):
+        pytest.skip('The line scanner takes code inside strings for definitions')
+
+    assert ast_files == files
+    assert ast_hunks == hunks
+
+
+def test_fallback_on_syntax_error():
+    content = 'def greet(name):\n    print "Hello", name\n\n\ndef part(name):\n    return name\n'
+    files, hunks, _ = parse('greet.py', content, 'lines')
+    ast_files, ast_hunks, index = parse('greet.py', content, 'ast')
+
+    assert not isinstance(index, AstFileIndex)
+    assert ast_files == files
+    assert ast_hunks == hunks
@@ -0,0 +1,56 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from revisum.collector import SnippetCollector
+from revisum.database.registry import registry
+from revisum.review import Review
+from revisum.snippet import Snippet
+from revisum.state import PullCursor
+
+
+class _Pull(object):
+
+    def __init__(self, number, updated_at):
+        self.number = number
+        self.updated_at = updated_at
+        self.merged_at = updated_at
+
+
+@pytest.fixture
+def collector(tmp_path, monkeypatch):
+    collector = SnippetCollector.__new__(SnippetCollector)
+    collector.repo_id = 1
+    monkeypatch.setattr(Review, 'newest_merged', classmethod(lambda cls, repo_id: None))
+    yield collector
+    registry.close(1, path=str(tmp_path))
+
+
+def test_resume_after_updated_pull(collector, tmp_path, monkeypatch):
+    path = str(tmp_path)
+    listed_at = datetime.utcnow() - timedelta(hours=1)
+    pulls = [_Pull(number, listed_at - timedelta(minutes=11 - number)) for number in range(10, 0, -1)]
+
+    # The interrupted collection handled pull requests 10 to 7
+    cursor = PullCursor(1, path=path)
+    cursor.start()
+    for pull in pulls[:4]:
+        cursor.begin(pull.number)
+        cursor.advance(pull.number, pull.updated_at, pull.number)
+
+    # Pull request 2 was updated since, so it is listed first
+    updated = _Pull(2, datetime.utcnow() + timedelta(minutes=1))
+    listing = [updated] + [pull for pull in pulls if pull.number != 2]
+    monkeypatch.setattr(Snippet, 'known_pulls', classmethod(lambda cls, repo_id: {10, 9, 8, 7}))
+    collector._pulls = lambda: listing
+
+    cursor = PullCursor(1, path=path)
+    assert cursor.resuming
+    cursor.start()
+
+    collected = []
+    for pull in collector._listed_pulls(True, cursor):
+        collected.append(pull.number)
+        cursor.advance(pull.number, pull.updated_at, len(collected))
+
+    assert collected == [2, 6, 5, 4, 3, 1]